@@ -14,7 +14,7 @@ from cassandra.auth import PlainTextAuthProvider
 from cassandra.query import BatchStatement, SimpleStatement, ConsistencyLevel
 from cassandra.auth import PlainTextAuthProvider
 from cassandra.cqlengine import connection
-from cassandra import ConsistencyLevel
+from cassandra import ConsistencyLevel, InvalidRequest
 from cassandra.policies import TokenAwarePolicy, DCAwareRoundRobinPolicy
 
 from collections import defaultdict
@@ -175,11 +175,25 @@ def main():
         # print(cntr)
         # count = len(hourle_devs)        
 
+        # hours the loaders rolled up in-stream (dataload/rollup.py) are theirs:
+        # hourly_data is recomputed from their partials, adding ours would count twice
+        streamed = set()
+        try:
+            partials = session.execute(
+                "SELECT dev_eui, measurement FROM hourly_partials WHERE yearday = %s AND hour = %s ALLOW FILTERING",
+                (yearday, hour))
+            streamed = {(row.dev_eui, row.measurement) for row in partials}
+        except InvalidRequest:
+            pass  # no hourly_partials table, the in-stream rollup was never enabled
+        logging.info("streamed: " + str(len(streamed)))
+
         sql_tx = """
             INSERT INTO hourly_data (dev_eui, measurement, min, max, ave, sum, count, yearday, hour)
             VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
             """
         for key in aggr_devs:
+            if (aggr_devs[key], aggr_measurement[key]) in streamed:
+                continue
             cntr += 1
             session.execute(sql_tx, (aggr_devs[key], aggr_measurement[key], aggr_min[key], 
                                    aggr_max[key], aggr_ave[key], aggr_sums[key], aggr_count[key],
@@ -0,0 +1,297 @@
+import argparse
+import configparser
+import json
+import os
+import re
+import time
+from datetime import datetime
+
+try:
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+from formats import fast_dumps, write_parquet
+from timestamps import TimestampParser
+
+# Daily archive of the raw uplinks as compressed Parquet, laid out as
+#
+#   <root>/app_name=<application_id>/yyyymmdd=<day>/part-*.parquet
+#
+# so one /pkts query (one app_name, one day) reads one directory. The key
+# fields are columns, the full uplink is kept in tts_json or actility_json
+# like rawjson_data does. Each loader flush stages its uplinks in the day's
+# _staging-<worker>/ directory; the loader rolls those into one part file
+# once they reach roll_mb or the oldest is roll_minutes old. `archive.py
+# compact` merges the part files of a finished day into one file per
+# application and `archive.py pkts` answers the /pkts filters from the
+# part and staged files:
+#
+#   python archive.py compact --day 20241023
+#   python archive.py pkts --app pt_iaq --day 20241023 --from 08:00 --to 09:30 --device eui-70b3d57ed0000001
+
+COLUMNS = ("device_name", "dev_eui", "ts", "f_cnt", "f_port", "tts_json", "actility_json")
+NAME = re.compile(r"^[A-Za-z0-9._@-]+$")
+DAY = re.compile(r"^\d{8}$")
+F_CNT_MAX = 2 ** 32 - 1  # LoRaWAN frame counters are 32 bits, ports 8
+F_PORT_MAX = 255
+
+if pa is not None:
+    SCHEMA = pa.schema([
+        ("device_name", pa.string()),
+        ("dev_eui", pa.string()),
+        ("ts", pa.timestamp("us")),
+        ("f_cnt", pa.int64()),
+        ("f_port", pa.int32()),
+        ("tts_json", pa.string()),
+        ("actility_json", pa.string()),
+    ])
+
+
+def _day_directory(root, app_name, yyyymmdd):
+    if not NAME.match(app_name) or not DAY.match(str(yyyymmdd)):
+        raise ValueError(f"bad app_name or yyyymmdd: {app_name!r} {yyyymmdd!r}")
+    return os.path.join(root, f"app_name={app_name}", f"yyyymmdd={yyyymmdd}")
+
+
+def _counter(value, limit):
+    """value as an int in 0..limit, None when missing; raises ValueError or TypeError otherwise."""
+    if value is None:
+        return None
+    number = int(value)
+    if not 0 <= number <= limit:
+        raise ValueError(f"{value!r} out of range")
+    return number
+
+
+class UplinkArchive:
+    """Collects raw uplinks and writes them as Parquet part files.
+
+    add() is the UplinkDecoder archive hook and takes every parsed
+    document; flush() stages one file per (application, day) buffered since
+    the last one, then rolls the staged files that are due into a part
+    file. The Pipeline flushes the archive before it commits offsets, so an
+    archive that cannot be staged holds the commit back. Staged files left
+    by an earlier process of the same worker are rolled like new ones; a
+    crash between writing a part and removing its staged files leaves those
+    uplinks in the archive twice. Uplinks whose f_cnt or f_port is not a
+    counter in range, or whose ids are not strings, are counted as skipped.
+    """
+
+    def __init__(self, root, worker=0, compression="zstd", roll_bytes=64 * 1024 * 1024, roll_seconds=3600):
+        if pa is None:
+            raise RuntimeError("the uplink archive needs pyarrow")
+        self.root = root
+        self.worker = worker
+        self.compression = compression
+        self.roll_bytes = roll_bytes
+        self.roll_seconds = roll_seconds
+        self.parse_ts = TimestampParser().parse
+        self.buffers = {}  # (app_name, yyyymmdd): {column: [values]}
+        self.staged = {}  # (app_name, yyyymmdd): [staged paths], oldest first
+        self.sequence = 0
+
+        self.uplinks = 0
+        self.skipped = 0
+        self.files = 0
+        self.parts = 0
+        self.bytes = 0
+        self._find_staged()
+
+    def _find_staged(self):
+        staging = f"_staging-{self.worker}"
+        if not os.path.isdir(self.root):
+            return
+        for app_entry in os.listdir(self.root):
+            if not app_entry.startswith("app_name="):
+                continue
+            for day_entry in os.listdir(os.path.join(self.root, app_entry)):
+                directory = os.path.join(self.root, app_entry, day_entry, staging)
+                if not day_entry.startswith("yyyymmdd=") or not os.path.isdir(directory):
+                    continue
+                paths = sorted(os.path.join(directory, name) for name in os.listdir(directory)
+                               if name.startswith("part-") and name.endswith(".parquet"))
+                if paths:
+                    self.staged[(app_entry[9:], int(day_entry[9:]))] = paths
+
+    def add(self, document):
+        try:
+            payload = document["payload"]
+            ids = payload["end_device_ids"]
+            app_name = ids["application_ids"]["application_id"]
+            uplink = payload["uplink_message"]
+            ts = self.parse_ts(uplink["received_at"])[0]
+            f_cnt = _counter(uplink.get("f_cnt"), F_CNT_MAX)
+            f_port = _counter(uplink.get("f_port"), F_PORT_MAX)
+        except (KeyError, IndexError, TypeError, ValueError, AttributeError):
+            self.skipped += 1
+            return
+        device_name = ids.get("device_id")
+        dev_eui = ids.get("dev_eui")
+        if not isinstance(app_name, str) or not NAME.match(app_name):
+            self.skipped += 1
+            return
+        if not isinstance(device_name, (str, type(None))) or not isinstance(dev_eui, (str, type(None))):
+            self.skipped += 1
+            return
+        key = (app_name, ts.year * 10000 + ts.month * 100 + ts.day)
+        columns = self.buffers.get(key)
+        if columns is None:
+            columns = self.buffers[key] = {name: [] for name in COLUMNS}
+        raw = fast_dumps(payload).decode("utf-8")
+        actility = "actility_customer_id" in payload
+        columns["device_name"].append(device_name)
+        columns["dev_eui"].append(dev_eui)
+        columns["ts"].append(ts)
+        columns["f_cnt"].append(f_cnt)
+        columns["f_port"].append(f_port)
+        columns["tts_json"].append(None if actility else raw)
+        columns["actility_json"].append(raw if actility else None)
+        self.uplinks += 1
+
+    def pending(self):
+        return sum(len(columns["ts"]) for columns in self.buffers.values())
+
+    def _part_path(self, directory):
+        # the name carries the time it was written, which roll() goes by
+        self.sequence += 1
+        return os.path.join(directory, f"part-{self.worker}-{int(time.time() * 1000)}-{self.sequence:06d}.parquet")
+
+    def flush(self):
+        """Stages the buffered uplinks; raises OSError and keeps them when the disk does."""
+        for key in list(self.buffers):
+            app_name, yyyymmdd = key
+            try:
+                table = pa.table(self.buffers[key], schema=SCHEMA)
+            except pa.ArrowException as e:
+                # kept, they would hold back every commit from now on
+                count = len(self.buffers.pop(key)["ts"])
+                self.skipped += count
+                print(f"{datetime.now()} {count} uplinks of {app_name} {yyyymmdd} not archived: {e}")
+                continue
+            directory = os.path.join(_day_directory(self.root, app_name, yyyymmdd), f"_staging-{self.worker}")
+            os.makedirs(directory, exist_ok=True)
+            path = self._part_path(directory)
+            write_parquet(path, table, self.compression)
+            del self.buffers[key]
+            self.staged.setdefault(key, []).append(path)
+            self.files += 1
+            self.bytes += os.path.getsize(path)
+        self.roll()
+
+    def roll(self, force=False):
+        """Merges the staged files of each (application, day) that are due, or all with force, into a part file."""
+        now = time.time()
+        for key, paths in list(self.staged.items()):
+            if not force:
+                oldest = int(os.path.basename(paths[0]).split("-")[2]) / 1000
+                size = sum(os.path.getsize(path) for path in paths if os.path.exists(path))
+                if size < self.roll_bytes and now - oldest < self.roll_seconds:
+                    continue
+            try:
+                table = pa.concat_tables(pq.read_table(path, schema=SCHEMA) for path in paths).sort_by("ts")
+                write_parquet(self._part_path(_day_directory(self.root, *key)), table, self.compression)
+                for path in paths:
+                    os.remove(path)
+            except OSError as e:
+                # the staged files are on disk already, the next flush tries again
+                print(f"{datetime.now()} archive roll of {key[0]} {key[1]} failed: {e}")
+                continue
+            del self.staged[key]
+            self.parts += 1
+
+    def close(self):
+        """Rolls everything staged, on shutdown."""
+        self.roll(force=True)
+
+
+def compact(root, yyyymmdd, compression="zstd"):
+    """Merges each application's part files of a finished day into one file.
+
+    Staged files are left to the loaders, which roll them into part files.
+    """
+    merged = 0
+    for entry in sorted(os.listdir(root)):
+        if not entry.startswith("app_name="):
+            continue
+        directory = _day_directory(root, entry[9:], yyyymmdd)
+        if not os.path.isdir(directory):
+            continue
+        parts = sorted(os.path.join(directory, name) for name in os.listdir(directory)
+                       if name.startswith("part-") and name.endswith(".parquet"))
+        if len(parts) < 2:
+            continue
+        table = pa.concat_tables(pq.read_table(part, schema=SCHEMA) for part in parts).sort_by("ts")
+        write_parquet(os.path.join(directory, f"part-day-{yyyymmdd}.parquet"), table, compression)
+        for part in parts:
+            if not part.endswith(f"part-day-{yyyymmdd}.parquet"):
+                os.remove(part)
+        merged += 1
+    return merged
+
+
+def read_pkts(root, app_name, yyyymmdd, frtime=None, totime=None, device_name=None):
+    """The rows /pkts returns for the same filters, from the archive.
+
+    frtime and totime are "HH:MM" on that day, both inclusive like the
+    Cassandra query; rows come back as dicts in ts order.
+    """
+    directory = _day_directory(root, app_name, yyyymmdd)
+    if not os.path.isdir(directory):
+        return []
+    day = datetime.strptime(str(yyyymmdd), "%Y%m%d").date()
+    condition = None
+
+    def both(expression):
+        return expression if condition is None else condition & expression
+
+    if frtime:
+        condition = both(ds.field("ts") >= datetime.combine(day, datetime.strptime(frtime, "%H:%M").time()))
+    if totime:
+        condition = both(ds.field("ts") <= datetime.combine(day, datetime.strptime(totime, "%H:%M").time()))
+    if device_name:
+        condition = both(ds.field("device_name") == device_name)
+
+    paths = []
+    for entry in sorted(os.listdir(directory)):
+        path = os.path.join(directory, entry)
+        if entry.startswith("_staging-") and os.path.isdir(path):
+            paths.extend(os.path.join(path, name) for name in sorted(os.listdir(path)) if name.endswith(".parquet"))
+        elif entry.endswith(".parquet"):
+            paths.append(path)
+    dataset = ds.dataset(paths, format="parquet", schema=SCHEMA)
+    table = dataset.to_table(filter=condition).sort_by("ts")
+    rows = table.to_pylist()
+    for row in rows:
+        row["app_name"] = app_name
+        row["yyyymmdd"] = int(yyyymmdd)
+    return rows
+
+
+def main():
+    config = configparser.ConfigParser()
+    config.read('config.ini')
+    parser = argparse.ArgumentParser(description="Raw uplink archive")
+    parser.add_argument('--root', default=config.get('archive', 'directory', fallback='/var/lib/packetthings/archive'))
+    commands = parser.add_subparsers(dest='command', required=True)
+    compact_parser = commands.add_parser('compact', help="merge the part files of a finished day")
+    compact_parser.add_argument('--day', required=True, help="yyyymmdd")
+    pkts_parser = commands.add_parser('pkts', help="query like /pkts")
+    pkts_parser.add_argument('--app', required=True)
+    pkts_parser.add_argument('--day', required=True, help="yyyymmdd")
+    pkts_parser.add_argument('--from', dest='frtime', help="HH:MM")
+    pkts_parser.add_argument('--to', dest='totime', help="HH:MM")
+    pkts_parser.add_argument('--device', help="device_name")
+    args = parser.parse_args()
+
+    if args.command == 'compact':
+        print(f"{datetime.now()} compacted {compact(args.root, args.day)} applications for {args.day}")
+    else:
+        for row in read_pkts(args.root, args.app, args.day, args.frtime, args.totime, args.device):
+            print(json.dumps(row, default=str))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+import os
+import zlib
+from datetime import datetime
+
+# Rows spilled while the circuit breaker is open, one compressed segment
+# file per spill:
+#
+#   <directory>/segment-<sequence>-<rows>.zlib
+#
+# holding rowbuffer.RowBuffer.encode() output compressed with zlib. A file
+# is written under a temporary name and fsynced before it is renamed, so
+# once spill() returns the rows are safe to commit past in Kafka. Segments
+# left by an earlier process are drained like new ones.
+#
+# The latest_data rows the writer keeps buffered while the breaker is open
+# are written to <directory>/latest.zlib the same way, replaced on every
+# spill and removed once a flush has written them, so they survive a
+# restart as well.
+
+
+class Backlog:
+    """Compressed segment files of device_data rows waiting for Cassandra."""
+
+    def __init__(self, directory, level=6):
+        self.directory = directory
+        self.level = level
+        os.makedirs(directory, exist_ok=True)
+        self.latest_path = os.path.join(directory, "latest.zlib")
+        self.has_latest = os.path.exists(self.latest_path)
+        self.segments = []  # (path, rows), oldest first
+        self.sequence = 0
+        for name in sorted(os.listdir(directory)):
+            if name.startswith("segment-") and name.endswith(".zlib"):
+                sequence, rows = name[8:-5].split("-")
+                self.segments.append((os.path.join(directory, name), int(rows)))
+                self.sequence = max(self.sequence, int(sequence))
+
+        self.spilled = 0
+        self.drained = 0
+        self.bytes_written = 0
+
+    def rows(self):
+        return sum(rows for path, rows in self.segments)
+
+    def _write(self, path, data):
+        temporary = path + ".tmp"
+        with open(temporary, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary, path)
+
+    def spill(self, buffer, first, last):
+        """Writes rows first..last of a RowBuffer as one segment. Raises OSError."""
+        if last <= first:
+            return
+        data = zlib.compress(buffer.encode(first, last), self.level)
+        self.sequence += 1
+        path = os.path.join(self.directory, f"segment-{self.sequence:010d}-{last - first}.zlib")
+        self._write(path, data)
+        self.segments.append((path, last - first))
+        self.spilled += last - first
+        self.bytes_written += len(data)
+
+    def load(self, buffer, max_rows):
+        """Appends the oldest segments, at least one and about max_rows rows, to buffer.
+
+        Returns the segments loaded, to pass to remove() once their rows are written.
+        """
+        loaded = []
+        rows = 0
+        for path, count in list(self.segments):
+            if loaded and rows + count > max_rows:
+                break
+            with open(path, "rb") as f:
+                data = f.read()
+            try:
+                data = zlib.decompress(data)
+            except zlib.error as e:
+                # set aside rather than retried on every flush
+                print(f"{datetime.now()} backlog segment {path} is unreadable, moved to {path}.bad: {e}")
+                os.replace(path, path + ".bad")
+                self.segments.remove((path, count))
+                continue
+            buffer.extend_encoded(data)
+            loaded.append((path, count))
+            rows += count
+        return loaded
+
+    def remove(self, segments):
+        for segment in segments:
+            os.remove(segment[0])
+            self.segments.remove(segment)
+            self.drained += segment[1]
+
+    def save_latest(self, buffer, first, last):
+        """Replaces the kept latest_data rows with rows first..last of a RowBuffer. Raises OSError."""
+        if last <= first:
+            self.clear_latest()
+            return
+        self._write(self.latest_path, zlib.compress(buffer.encode(first, last), self.level))
+        self.has_latest = True
+
+    def load_latest(self, buffer):
+        """Appends the kept latest_data rows to buffer; returns how many."""
+        if not self.has_latest:
+            return 0
+        with open(self.latest_path, "rb") as f:
+            data = f.read()
+        try:
+            return buffer.extend_encoded(zlib.decompress(data))
+        except zlib.error as e:
+            print(f"{datetime.now()} backlog latest rows {self.latest_path} are unreadable, ignored: {e}")
+            return 0
+
+    def clear_latest(self):
+        if self.has_latest:
+            if os.path.exists(self.latest_path):
+                os.remove(self.latest_path)
+            self.has_latest = False
@@ -0,0 +1,40 @@
+from datetime import datetime
+
+
+class Backpressure:
+    """Pauses the consumer's partitions while the write buffer is too deep.
+
+    update() is called from the consume loop with the number of buffered
+    rows. At high_water the assigned partitions are paused, so consume()
+    keeps serving rebalances and heartbeats but returns no messages; once
+    flushes bring the buffer down to low_water they are resumed.
+    """
+
+    def __init__(self, high_water=50000, low_water=20000):
+        self.high_water = high_water
+        self.low_water = low_water
+        self.paused = []
+        self.depth = 0
+        self.pauses = 0
+
+    def is_paused(self):
+        return bool(self.paused)
+
+    def update(self, consumer, depth):
+        self.depth = depth
+        if depth >= self.high_water:
+            assignment = consumer.assignment()
+            # re-pause if a rebalance handed us partitions since the last pause
+            if assignment and assignment != self.paused:
+                if not self.paused:
+                    self.pauses += 1
+                    print(f"{datetime.now()} {depth} rows buffered, pausing {len(assignment)} partitions")
+                consumer.pause(assignment)
+                self.paused = assignment
+        elif self.paused and depth <= self.low_water:
+            consumer.resume(consumer.assignment())
+            self.paused = []
+            print(f"{datetime.now()} {depth} rows buffered, resuming")
+
+    def reset(self):
+        self.paused = []
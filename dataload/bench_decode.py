@@ -0,0 +1,122 @@
+import json
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+import schedule
+
+from decoder import payload_dict
+from fakes import FakeConsumer
+from uplinks import UplinkDecoder
+from measurements import MeasurementMap
+from timestamps import TimestampParser
+
+# Compares the old one-message-at-a-time consume path (poll, run_pending,
+# msg_process -> pt_to_db per message) with Consumer.consume() batches fed
+# through UplinkDecoder.decode_batch, with json.loads and with the default
+# (orjson) parser. No Kafka or Cassandra needed:
+#
+#   python bench_decode.py [messages] [batch_size]
+
+
+def make_values(count):
+    start = datetime(2024, 10, 23, 4, 0, 0)
+    values = []
+    for i in range(count):
+        received_at = (start + timedelta(seconds=i)).strftime("%Y-%m-%dT%H:%M:%S.%f") + "Z"
+        uplink = {
+            "end_device_ids": {
+                "device_id": f"eui-{i % 500:016x}",
+                "application_ids": {"application_id": random.choice(["pt_iaq", "pt_modbus", "pt_door"])},
+                "dev_eui": f"{i % 500:016X}",
+            },
+            "received_at": received_at,
+            "uplink_message": {
+                "f_cnt": i,
+                "f_port": 2,
+                "decoded_payload": {
+                    "temperature": round(random.uniform(20, 35), 2),
+                    "humidity": round(random.uniform(40, 90), 2),
+                    "battery": 3.6,
+                    "co2": random.randint(400, 2000),
+                    "raw_payload": "01 03 10 43",
+                },
+                "received_at": received_at,
+            },
+        }
+        values.append(json.dumps({"payload": uplink}).encode("utf-8"))
+    return values
+
+
+def per_message(values, rows):
+    # The path the loaders had before batching.
+    def pt_to_db(payload):
+        ts_str = payload["uplink_message"]["received_at"].split("Z")[0][0:26]
+        dev_eui = payload["end_device_ids"]["dev_eui"]
+        application_id = payload["end_device_ids"]["application_ids"]["application_id"]
+        ts = datetime.strptime(ts_str, "%Y-%m-%dT%H:%M:%S.%f")
+        yearmonth = (ts.year % 100) * 100 + ts.month
+        if "decoded_payload" not in payload["uplink_message"] or "received_at" not in payload["uplink_message"]:
+            return
+        for key, value in payload["uplink_message"]["decoded_payload"].items():
+            if isinstance(value, (int, float)):
+                try:
+                    key = payload_dict[key.lower()]
+                    rows.append((dev_eui, key, yearmonth, ts, application_id, value))
+                except:
+                    continue
+
+    def msg_process(msg):
+        data = json.loads(msg)
+        try:
+            pt_to_db(data["payload"])
+        except:
+            pass
+
+    consumer = FakeConsumer(values)
+    while True:
+        schedule.run_pending()
+        msg = consumer.poll(timeout=1.0)
+        if msg is None:
+            break
+        msg_process(msg.value().decode("utf-8"))
+
+
+def batched(values, rows, batch_size, loads=None):
+    decoder = UplinkDecoder(MeasurementMap(payload_dict, None), TimestampParser().parse, loads=loads)
+    consumer = FakeConsumer(values)
+    while True:
+        schedule.run_pending()
+        msgs = consumer.consume(num_messages=batch_size, timeout=1.0)
+        if not msgs:
+            break
+        rows.extend(decoder.decode_batch([msg.value() for msg in msgs]))
+
+
+def run(name, func, count):
+    rows = []
+    start = time.perf_counter()
+    func(rows)
+    elapsed = time.perf_counter() - start
+    print(f"{name:<24} {count / elapsed:>10.0f} msgs/s {len(rows) / elapsed:>10.0f} rows/s "
+          f"{elapsed / count * 1e6:>8.2f} us/msg")
+    return elapsed
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    batch_size = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+    schedule.every(60).seconds.do(lambda: None)
+    values = make_values(count)
+
+    base = run("poll + msg_process", lambda rows: per_message(values, rows), count)
+    single = run("consume(1) + decode", lambda rows: batched(values, rows, 1), count)
+    run(f"consume({batch_size}) + json", lambda rows: batched(values, rows, batch_size, json.loads), count)
+    batch = run(f"consume({batch_size}) + decode", lambda rows: batched(values, rows, batch_size), count)
+    print(f"saved per message: {(base - batch) / count * 1e6:.2f} us vs poll path, "
+          f"{(single - batch) / count * 1e6:.2f} us vs batch size 1")
+
+
+if __name__ == "__main__":
+    main()
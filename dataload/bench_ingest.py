@@ -0,0 +1,119 @@
+import argparse
+import shutil
+import tempfile
+import time
+
+from commits import CommitManager
+from decoder import payload_dict
+from fakes import FakeConsumer, FakePrepared, RecordingSession
+from ingest import Pipeline
+from measurements import MeasurementMap
+from quarantine import Quarantine
+from spool import Spool
+from synthetic import make_uplinks
+from timestamps import TimestampParser
+from uplinks import UplinkDecoder
+from writer import CassandraWriter
+
+# Runs the whole ingest path offline: synthetic TTS/Actility uplinks come out
+# of a fake Consumer, go through the same Pipeline the loaders use (decode,
+# spool, buffer, flush, commit) and are written to a session that records
+# the statements and answers after a simulated latency.
+#
+#   python bench_ingest.py --messages 200000 --mode concurrent --latency 0.002
+#
+# Prints msgs/s and rows/s for the run and p50/p95/p99 latency per stage.
+
+DATA_INSERT = ("INSERT INTO device_data (dev_eui, measurement, yearmonth, ts, source_application_id, value) "
+               "VALUES (%s, %s, %s, %s, %s, %s)")
+LATEST_INSERT = ("INSERT INTO latest_data (dev_eui, measurement, ts, source_application_id, value) "
+                 "VALUES (%s, %s, %s, %s, %s)")
+
+
+class StageTimes:
+
+    def __init__(self):
+        self.seconds = {}
+        self.sizes = {}
+
+    def observe(self, stage, seconds, size):
+        self.seconds.setdefault(stage, []).append(seconds)
+        self.sizes[stage] = self.sizes.get(stage, 0) + size
+
+    def report(self):
+        print(f"{'stage':<8} {'calls':>7} {'items':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+        for stage, seconds in self.seconds.items():
+            ordered = sorted(seconds)
+            print(f"{stage:<8} {len(ordered):>7} {self.sizes[stage]:>9} "
+                  f"{percentile(ordered, 50) * 1000:>9.3f} {percentile(ordered, 95) * 1000:>9.3f} "
+                  f"{percentile(ordered, 99) * 1000:>9.3f} {ordered[-1] * 1000:>9.3f}")
+
+
+def percentile(ordered, p):
+    if not ordered:
+        return 0.0
+    index = min(len(ordered) - 1, max(0, int(round(p / 100 * len(ordered))) - 1))
+    return ordered[index]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmark of the ingest pipeline")
+    parser.add_argument("--messages", type=int, default=100000)
+    parser.add_argument("--devices", type=int, default=2000)
+    parser.add_argument("--batch-size", type=int, default=500, help="Consumer.consume() batch size")
+    parser.add_argument("--mode", default="concurrent", choices=["concurrent", "partition", "batch"])
+    parser.add_argument("--max-rows", type=int, default=5000)
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--latency", type=float, default=0.002, help="simulated seconds per Cassandra request")
+    parser.add_argument("--no-spool", action="store_true")
+    args = parser.parse_args()
+
+    values = make_uplinks(args.messages, devices=args.devices)
+    consumer = FakeConsumer(values)
+
+    session = RecordingSession(latency=args.latency, record=False)
+    writer = CassandraWriter(session, FakePrepared(DATA_INSERT), FakePrepared(LATEST_INSERT),
+                             mode=args.mode, max_rows=args.max_rows, max_interval=3600,
+                             concurrency=args.concurrency)
+    quarantine = Quarantine()
+    decoder = UplinkDecoder(MeasurementMap(payload_dict, None), TimestampParser().parse, quarantine=quarantine)
+    offsets = CommitManager(quarantine)
+    times = StageTimes()
+    pipeline = Pipeline(decoder, writer, offsets, observe=times.observe)
+
+    spool_directory = None
+    if not args.no_spool:
+        spool_directory = tempfile.mkdtemp(prefix="bench-spool-")
+        pipeline.spool = Spool(spool_directory, 64 * 1024 * 1024)
+        pipeline.spool.replay()
+
+    start = time.perf_counter()
+    while True:
+        msgs = consumer.consume(num_messages=args.batch_size, timeout=1.0)
+        if not msgs:
+            break
+        pipeline.process(msgs)
+        if writer.due():
+            pipeline.flush(consumer)
+    # whatever the quarantine recovered in the meantime
+    deadline = time.monotonic() + 1.0
+    while quarantine.pending() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    pipeline.process([])
+    pipeline.flush(consumer, asynchronous=False)
+    elapsed = time.perf_counter() - start
+
+    if pipeline.spool is not None:
+        pipeline.spool.close()
+        shutil.rmtree(spool_directory, ignore_errors=True)
+
+    print(f"{args.messages} messages, {writer.rows_written} rows, {writer.latest_written} latest_data rows "
+          f"({writer.latest_coalesced} coalesced), {session.requests} requests in {elapsed:.2f}s")
+    print(f"{args.messages / elapsed:.0f} msgs/s, {writer.rows_written / elapsed:.0f} rows/s, "
+          f"{decoder.parse_failures} parse failures ({quarantine.recovered_count} recovered), "
+          f"{decoder.unmapped} unmapped, {offsets.commit_count} commits")
+    times.report()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+import argparse
+import gc
+import tracemalloc
+
+from decoder import payload_dict
+from measurements import MeasurementMap
+from rowbuffer import RowBuffer, StringTable
+from synthetic import make_uplinks
+from timestamps import TimestampParser
+from uplinks import UplinkDecoder
+
+# Bytes per buffered row: the decoder's row tuples held in a list plus the
+# newest row per (dev_eui, measurement) in a dict, the way CassandraWriter
+# buffered them before, against the columnar rowbuffer.RowBuffer. Measured
+# with tracemalloc as what stays allocated once --rows rows are buffered;
+# the Kafka values are made beforehand and the decoder is warmed up, so
+# neither is counted.
+#
+#   python bench_memory.py --rows 50000 --devices 2000
+
+
+class TupleBuffer:
+    """The previous CassandraWriter buffer."""
+
+    def __init__(self):
+        self.rows = []
+        self.latest = {}
+
+    def add_many(self, rows):
+        self.rows.extend(rows)
+        latest = self.latest
+        for row in rows:
+            key = (row[0], row[1])
+            current = latest.get(key)
+            if current is None or row[3] >= current[3]:
+                latest[key] = row
+
+    def __len__(self):
+        return len(self.rows)
+
+
+def measure(make_buffer, batches, decoder):
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    buffer = make_buffer()
+    for values in batches:
+        buffer.add_many(decoder.decode_batch(values))
+    gc.collect()
+    held = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return buffer, held
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Memory per buffered row")
+    parser.add_argument("--rows", type=int, default=50000, help="approximate rows to buffer")
+    parser.add_argument("--devices", type=int, default=2000)
+    parser.add_argument("--batch-size", type=int, default=500)
+    args = parser.parse_args()
+
+    # about 3.7 mapped rows per synthetic uplink
+    values = make_uplinks(int(args.rows / 3.7), devices=args.devices, repr_share=0)
+    batches = [values[i:i + args.batch_size] for i in range(0, len(values), args.batch_size)]
+    decoder = UplinkDecoder(MeasurementMap(payload_dict, None), TimestampParser().parse)
+    for values in batches:
+        decoder.decode_batch(values)
+
+    print(f"{'buffer':<12} {'rows':>8} {'bytes':>12} {'bytes/row':>10}")
+    for name, make_buffer in (("tuples", TupleBuffer), ("columnar", lambda: RowBuffer(StringTable()))):
+        buffer, held = measure(make_buffer, batches, decoder)
+        print(f"{name:<12} {len(buffer):>8} {held:>12} {held / len(buffer):>10.1f}")
+        if isinstance(buffer, RowBuffer):
+            print(f"{'':<12} {'':>8} {buffer.nbytes():>12} {buffer.nbytes() / len(buffer):>10.1f}  (columns only)")
+        del buffer
+
+
+if __name__ == "__main__":
+    main()
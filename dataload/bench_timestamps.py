@@ -0,0 +1,60 @@
+import sys
+import time
+from datetime import datetime, timedelta
+
+from timestamps import TimestampParser
+
+# Micro-benchmark for received_at parsing: the strptime chain ac_data_load.py
+# used, datetime.fromisoformat and TimestampParser, over the formats we see.
+#
+#   python bench_timestamps.py [count]
+
+
+def strptime_chain(received_at):
+    ts_str = received_at.split("Z")[0][0:26]
+    try:
+        ts = datetime.strptime(ts_str, "%Y-%m-%dT%H:%M:%S.%f")
+    except ValueError:
+        try:
+            ts = datetime.strptime(ts_str, "%Y-%m-%dT%H:%M:%S%z")
+        except ValueError:
+            pass
+    ts = datetime.strptime(ts_str[0:19], "%Y-%m-%dT%H:%M:%S")
+    return ts, (ts.year % 100) * 100 + ts.month
+
+
+def fromisoformat(received_at):
+    ts = datetime.fromisoformat(received_at[0:26].rstrip("Z"))
+    return ts, (ts.year % 100) * 100 + ts.month
+
+
+def make_values(count):
+    start = datetime(2024, 10, 23, 4, 0, 0)
+    formats = [
+        lambda t: t.strftime("%Y-%m-%dT%H:%M:%S.%f") + "123Z",
+        lambda t: t.strftime("%Y-%m-%dT%H:%M:%S") + "+0000",
+        lambda t: t.strftime("%Y-%m-%dT%H:%M:%S.%f")[:23] + "Z",
+    ]
+    return [formats[i % 3](start + timedelta(milliseconds=137 * i)) for i in range(count)]
+
+
+def run(name, func, values):
+    start = time.perf_counter()
+    for value in values:
+        func(value)
+    elapsed = time.perf_counter() - start
+    print(f"{name:<16} {elapsed / len(values) * 1e9:>8.0f} ns/parse")
+    return elapsed
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 300000
+    values = make_values(count)
+    base = run("strptime", strptime_chain, values)
+    run("fromisoformat", fromisoformat, values)
+    fast = run("TimestampParser", TimestampParser().parse, values)
+    print(f"speedup over strptime: {base / fast:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
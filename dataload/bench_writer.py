@@ -0,0 +1,62 @@
+import argparse
+import time
+
+from bench_ingest import DATA_INSERT, LATEST_INSERT
+from decoder import payload_dict
+from fakes import FakePrepared, RecordingSession
+from measurements import MeasurementMap
+from synthetic import make_uplinks
+from timestamps import TimestampParser
+from uplinks import UplinkDecoder
+from writer import CassandraWriter
+
+# Compares the CassandraWriter modes on the same decoded rows: one
+# execute_async per row ("concurrent") against one unlogged batch per
+# device_data partition ("partition"), and optionally the old logged batch.
+# Requests cost --latency seconds plus --row-latency per row in a batch.
+# How much the partition mode saves depends on how many rows share a
+# partition within one flush, so it is run for several fleet sizes:
+#
+#   python bench_writer.py --messages 50000 --devices 50,500,5000
+
+
+def decode(messages, devices):
+    decoder = UplinkDecoder(MeasurementMap(payload_dict, None), TimestampParser().parse)
+    return decoder.decode_batch(make_uplinks(messages, devices=devices, repr_share=0))
+
+
+def run(rows, mode, args):
+    session = RecordingSession(latency=args.latency, row_latency=args.row_latency, record=False)
+    writer = CassandraWriter(session, FakePrepared(DATA_INSERT), FakePrepared(LATEST_INSERT),
+                             mode=mode, max_rows=args.max_rows, concurrency=args.concurrency,
+                             batch_rows=args.batch_rows)
+    start = time.perf_counter()
+    for i in range(0, len(rows), args.max_rows):
+        writer.add_many(rows[i:i + args.max_rows])
+        writer.flush()
+    elapsed = time.perf_counter() - start
+    return elapsed, session.requests, writer.rows_written
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare CassandraWriter modes")
+    parser.add_argument("--messages", type=int, default=50000)
+    parser.add_argument("--devices", default="50,500,5000", help="comma separated fleet sizes")
+    parser.add_argument("--modes", default="concurrent,partition")
+    parser.add_argument("--max-rows", type=int, default=5000)
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--batch-rows", type=int, default=100)
+    parser.add_argument("--latency", type=float, default=0.002, help="simulated seconds per request")
+    parser.add_argument("--row-latency", type=float, default=0.00005, help="extra seconds per row in a batch")
+    args = parser.parse_args()
+
+    print(f"{'devices':>8} {'mode':<11} {'rows':>8} {'requests':>9} {'seconds':>8} {'rows/s':>9}")
+    for devices in [int(d) for d in args.devices.split(",")]:
+        rows = decode(args.messages, devices)
+        for mode in args.modes.split(","):
+            elapsed, requests, written = run(rows, mode, args)
+            print(f"{devices:>8} {mode:<11} {written:>8} {requests:>9} {elapsed:>8.2f} {written / elapsed:>9.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,53 @@
+import time
+from datetime import datetime
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitBreaker:
+    """Tracks whether Cassandra is worth writing to.
+
+    Closed: flushes go to Cassandra. After `failures` flushes in a row have
+    failed it opens, and CassandraWriter spills to its backlog.Backlog
+    instead of retrying ever bigger buffers. Once reset_timeout seconds
+    have passed, allow() lets one flush through as a probe (half open): if
+    it succeeds the breaker closes, if it fails it opens for another
+    reset_timeout.
+    """
+
+    def __init__(self, failures=3, reset_timeout=30.0):
+        self.failures = failures
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+
+        self.opens = 0
+        self.probes = 0
+        self.closes = 0
+
+    def allow(self):
+        """True when the next flush should go to Cassandra."""
+        if self.state == OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+            self.state = HALF_OPEN
+            self.probes += 1
+            print(f"{datetime.now()} circuit breaker half open, probing Cassandra")
+        return self.state != OPEN
+
+    def success(self):
+        self.consecutive_failures = 0
+        if self.state != CLOSED:
+            self.state = CLOSED
+            self.closes += 1
+            print(f"{datetime.now()} circuit breaker closed")
+
+    def failure(self):
+        self.consecutive_failures += 1
+        if self.state == HALF_OPEN or (self.state == CLOSED and self.consecutive_failures >= self.failures):
+            self.state = OPEN
+            self.opened_at = time.monotonic()
+            self.opens += 1
+            print(f"{datetime.now()} circuit breaker open after {self.consecutive_failures} failed flushes, "
+                  f"spilling for {self.reset_timeout:.0f}s")
@@ -0,0 +1,52 @@
+from confluent_kafka import TopicPartition
+
+
+class CommitManager:
+    """Holds back offset commits until the rows they produced are in Cassandra.
+
+    processed() is called for every consumed message, commit() right after a
+    successful writer flush. Only the last processed offset per partition is
+    kept; Kafka delivers a partition in order, so it covers everything before
+    it and one commit covers everything consumed since the last flush. If a
+    partition is rewound (seek, redelivery after a rebalance) the commit
+    point moves back with it rather than skipping the replayed range.
+
+    With a quarantine.Quarantine, a partition is committed no further than
+    its oldest message still waiting there; it stays pending and is
+    committed further on a later flush, once the quarantine let go of it.
+    """
+
+    def __init__(self, quarantine=None):
+        self.quarantine = quarantine
+        self.offsets = {}
+        self.pending_messages = 0
+        self.commit_count = 0
+        self.committed_messages = 0
+
+    def processed(self, topic, partition, offset):
+        self.offsets[(topic, partition)] = offset
+        self.pending_messages += 1
+
+    def commit(self, consumer, asynchronous=True):
+        if not self.offsets:
+            return
+        partitions = []
+        held = {}
+        for (topic, partition), offset in self.offsets.items():
+            # Kafka expects the offset of the next message to read
+            next_offset = offset + 1
+            if self.quarantine is not None:
+                oldest = self.quarantine.oldest(topic, partition)
+                if oldest is not None and oldest < next_offset:
+                    next_offset = oldest
+                    held[(topic, partition)] = offset
+            partitions.append(TopicPartition(topic, partition, next_offset))
+        consumer.commit(offsets=partitions, asynchronous=asynchronous)
+        self.offsets = held
+        self.commit_count += 1
+        self.committed_messages += self.pending_messages
+        self.pending_messages = 0
+
+    def revoke(self, partitions):
+        for tp in partitions:
+            self.offsets.pop((tp.topic, tp.partition), None)
@@ -0,0 +1,52 @@
+class RecentUplinks:
+    """Remembers the most recent uplinks to drop the ones seen again.
+
+    Two generations of hashes: new keys go into the current set, and when
+    it holds capacity / 2 keys it becomes the previous set and the old
+    previous set is dropped. Memory stays bounded by capacity hashes, and
+    any key is remembered for at least the last capacity / 2 uplinks.
+    Keys are stored as their hash, so a collision (about one in 2**64 per
+    pair) could drop an uplink that is not a duplicate.
+
+    checkpoint() is called at each commit, and rollback() forgets the keys
+    recorded since then, when their messages are going to be delivered
+    again and must not be taken for duplicates.
+    """
+
+    def __init__(self, capacity=200000):
+        self.limit = max(1, capacity // 2)
+        self.current = set()
+        self.previous = set()
+        self.added = []  # hashes recorded since the last checkpoint
+
+        self.checked = 0
+        self.hits = 0
+        self.rotations = 0
+
+    def seen(self, key):
+        """True when key was seen recently; otherwise records it."""
+        self.checked += 1
+        h = hash(key)
+        if h in self.current or h in self.previous:
+            self.hits += 1
+            return True
+        current = self.current
+        current.add(h)
+        self.added.append(h)
+        if len(current) >= self.limit:
+            self.previous = current
+            self.current = set()
+            self.rotations += 1
+        return False
+
+    def checkpoint(self):
+        self.added = []
+
+    def rollback(self):
+        for h in self.added:
+            self.current.discard(h)
+            self.previous.discard(h)
+        self.added = []
+
+    def __len__(self):
+        return len(self.current) + len(self.previous)
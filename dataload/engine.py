@@ -0,0 +1,405 @@
+import logging
+import signal
+import time
+from datetime import datetime
+
+import schedule
+from cassandra.auth import PlainTextAuthProvider
+from cassandra.cluster import Cluster
+from confluent_kafka import Consumer, KafkaException, Producer, TopicPartition
+
+from archive import UplinkArchive
+from backlog import Backlog
+from backpressure import Backpressure
+from breaker import CircuitBreaker
+from commits import CommitManager
+from dedup import RecentUplinks
+from flush_scheduler import FlushScheduler
+from health import Heartbeat, HealthServer, consumer_lag
+from ingest import Pipeline
+from measurements import MeasurementMap
+from metrics import LoaderMetrics
+from quarantine import Quarantine
+from registry import DeviceRegistry, UnknownDiverter
+from rollup import HourlyRollup
+from sinks import DeviceSummSink, ParquetSink, PubSubSink, SpillFile
+from sources import source_for
+from spool import Spool
+from uplinks import UplinkDecoder
+from writer import CassandraWriter
+
+PING_MONITOR_INTERVAL_SECONDS = 60
+STATUS_INTERVAL_SECONDS = 10
+MEASUREMENT_RELOAD_SECONDS = 30
+CONSUME_BATCH_SIZE = 500
+CONSUME_BATCH_TIMEOUT = 1.0
+
+
+def commit_completed(err, partitions):
+    if err:
+        print(str(err))
+
+
+class IngestEngine:
+    """Everything a Kafka loader does between its topics and Cassandra.
+
+    The loaders (pt_data_load.py, ac_data_load.py, aicam/ac_data_load.py)
+    only differ in where their data lives and what it looks like: the
+    Cassandra cluster, the built-in payload_dict and the source decoder of
+    each topic. sources maps topic -> source name (see sources.py) and is
+    replaced by the [sources] section of config.ini when there is one; one
+    worker consumes all of its topics. The engine owns the connection, the
+    consume loop, batching, writing, health and metrics, configured from the
+    same config.ini sections as before.
+
+    main() runs one worker with the partition/worker number from the
+    command line, run_worker() is the supervisor.py entry point.
+    """
+
+    def __init__(self, config, payload_dict, sources, cassandra_host, cassandra_user, cassandra_pass,
+                 cassandra_port=9042, keyspace='packets', data_table='device_data', latest_table='latest_data',
+                 protocol_version=None, group_id='ptdata_prod', flush_interval=15):
+        self.config = config
+        self.partition_number = 0  # set from the command line by main() or by run_worker()
+        self.running = True
+        self.worker_counters = None  # shared [messages, rows] slot when run under supervisor.py
+        self.metrics = None  # LoaderMetrics, created by start_metrics()
+        self.spool = None  # opened by main() or run_worker() once the partition number is known
+        self.archive = None  # opened by open_archive() once the partition number is known
+
+        logging.basicConfig(filename=config.get('cplogs', 'log_path'),
+                            filemode='a',
+                            format='%(asctime)s,%(msecs)d %(name)s %(levelname)s %(message)s',
+                            datefmt='%H:%M:%S',
+                            level=logging.DEBUG)
+        logging.getLogger().setLevel(logging.WARNING)
+
+        self.kafka_broker = kafka_broker = config.get('kafka', 'broker')
+        if config.has_section('sources'):
+            sources = {topic: name for topic, name in config.items('sources') if topic not in config.defaults()}
+        self.topics = list(sources)
+        self.monitor_urls = config.get('monitor-info', 'urls').split(",")
+        self.monitor_timeout = config.getint('monitor-info', 'timeout', fallback=5)
+        self.health_port = config.getint('health', 'port', fallback=8700)  # plus the partition/worker number, 0 disables
+        self.metrics_port = config.getint('metrics', 'port', fallback=9700)  # plus the partition/worker number, 0 disables
+        self.consume_batch_size = config.getint('kafka', 'batch_size', fallback=CONSUME_BATCH_SIZE)
+        self.consume_batch_timeout = config.getfloat('kafka', 'batch_timeout', fallback=CONSUME_BATCH_TIMEOUT)
+        self.conf = {'bootstrap.servers': f"{kafka_broker}",
+                     'group.id': f"{config.get('kafka', 'group.id', fallback=group_id)}",
+                     'enable.auto.commit': False,
+                     'default.topic.config': {'auto.offset.reset': 'earliest'},
+                     'on_commit': commit_completed}
+
+        # Connect to the Cassandra cluster
+        auth_provider = PlainTextAuthProvider(username=cassandra_user, password=cassandra_pass)
+        options = {'protocol_version': protocol_version} if protocol_version else {}
+        self.cluster = Cluster(cassandra_host, port=cassandra_port, auth_provider=auth_provider, **options)
+        self.session = session = self.cluster.connect()
+        session.set_keyspace(keyspace)
+
+        data_prepared = session.prepare(
+            f"INSERT INTO {data_table} (dev_eui, measurement, yearmonth, ts, source_application_id, value) "
+            "VALUES (?, ?, ?, ?, ?, ?)")
+        latest_prepared = session.prepare(
+            f"INSERT INTO {latest_table} (dev_eui, measurement, ts, source_application_id, value) "
+            "VALUES (?, ?, ?, ?, ?)")
+        self.writer = writer = CassandraWriter(
+            session, data_prepared, latest_prepared,
+            mode=config.get('writer', 'mode', fallback='concurrent'),
+            max_rows=config.getint('writer', 'max_rows', fallback=5000),
+            max_interval=config.getint('writer', 'max_interval', fallback=flush_interval),
+            concurrency=config.getint('writer', 'concurrency', fallback=64),
+            batch_rows=config.getint('writer', 'batch_rows', fallback=100))
+        self.quarantine = Quarantine()
+        self.offsets = CommitManager(self.quarantine)
+        self.backpressure = Backpressure(high_water=config.getint('backpressure', 'high_water', fallback=50000),
+                                         low_water=config.getint('backpressure', 'low_water', fallback=20000))
+        self.spool_directory = config.get('spool', 'directory', fallback='/tmp/packetthings-spool')
+        self.spool_segment_mb = config.getint('spool', 'segment_mb', fallback=64)
+
+        self.measurements = MeasurementMap(payload_dict,
+                                           config.get('measurements', 'path', fallback='measurements.ini'))
+        # [registry] unknown = keep (count only), drop, or divert to divert_topic
+        # the registry is loaded and the diverter opened by open_registry()
+        self.registry = None
+        self.diverter = None
+        self.unknown_devices = unknown_devices = config.get('registry', 'unknown', fallback='keep')
+        if config.getboolean('registry', 'enabled', fallback=False):
+            self.registry = DeviceRegistry(config.get('registry', 'dsn'),
+                                           refresh=config.getint('registry', 'refresh_seconds', fallback=60),
+                                           full_refresh=config.getint('registry', 'full_refresh_seconds', fallback=3600))
+        self.dedup = None
+        if config.getboolean('dedup', 'enabled', fallback=True):
+            self.dedup = RecentUplinks(config.getint('dedup', 'capacity', fallback=200000))
+        self.decoder = UplinkDecoder(self.measurements, quarantine=self.quarantine, registry=self.registry,
+                                     drop_unknown=unknown_devices == 'drop', dedup=self.dedup,
+                                     sources={topic: source_for(name) for topic, name in sources.items()})
+        self.pipeline = pipeline = Pipeline(self.decoder, writer, self.offsets)
+        if config.getboolean('rollup', 'enabled', fallback=False):
+            pipeline.rollup = HourlyRollup(session, grace=config.getint('rollup', 'grace_seconds', fallback=300))
+            pipeline.rollup.registry = self.registry
+        self.scheduler = None
+        if config.getboolean('flush', 'adaptive', fallback=False):
+            self.scheduler = FlushScheduler(writer,
+                                            min_interval=config.getfloat('flush', 'min_interval', fallback=1.0),
+                                            max_interval=config.getfloat('flush', 'max_interval', fallback=flush_interval),
+                                            latency_target=config.getfloat('flush', 'latency_target', fallback=5.0),
+                                            size_target=config.getint('flush', 'size_target', fallback=5000))
+            pipeline.add_observer(self.scheduler.observe)
+
+        self.status = {}
+        self.status_time = 0.0
+        self.status_counts = (0, 0)
+        schedule.every(MEASUREMENT_RELOAD_SECONDS).seconds.do(self.measurements.reload_if_changed)
+
+    def update_status(self, consumer):
+        decoder, writer = self.decoder, self.writer
+        now = time.monotonic()
+        elapsed = now - self.status_time if self.status_time else STATUS_INTERVAL_SECONDS
+        messages, rows = decoder.messages, writer.rows_written
+        self.status = {
+            "partition": self.partition_number,
+            "topics": self.topics,
+            "messages": messages,
+            "rows_written": rows,
+            "messages_per_second": round((messages - self.status_counts[0]) / elapsed, 1),
+            "rows_per_second": round((rows - self.status_counts[1]) / elapsed, 1),
+            "buffered_rows": writer.pending(),
+            "flush_interval": round(writer.interval, 2),
+            "paused": self.backpressure.is_paused(),
+            "last_flush": writer.last_success,
+            "last_flush_failed": writer.last_flush_failed,
+            "breaker": writer.breaker.state if writer.breaker is not None else None,
+            "backlog_rows": writer.backlog.rows() if writer.backlog is not None else 0,
+            "consumer_lag": consumer_lag(consumer),
+            "commits": self.offsets.commit_count,
+            "quarantined": self.quarantine.received,
+            "quarantine_recovered": self.quarantine.recovered_count,
+            "quarantine_rejected": self.quarantine.rejected,
+            "quarantine_dropped": self.quarantine.dropped,
+            "unmapped": decoder.unmapped,
+            "unknown_devices": decoder.unknown,
+            "diverted": self.diverter.diverted if self.diverter is not None else 0,
+            "divert_dropped": self.diverter.dropped if self.diverter is not None else 0,
+            "duplicates": decoder.duplicates,
+        }
+        self.status_time = now
+        self.status_counts = (messages, rows)
+
+    def loop_alive(self):
+        return time.monotonic() - self.status_time < 3 * STATUS_INTERVAL_SECONDS
+
+    def current_status(self):
+        document = dict(self.status)
+        # an open circuit breaker keeps the loop going, but nothing reaches Cassandra
+        document["degraded"] = self.writer.degraded()
+        document["healthy"] = self.loop_alive() and not self.writer.last_flush_failed and not document["degraded"]
+        return document
+
+    def start_health(self):
+        Heartbeat(self.monitor_urls, interval=PING_MONITOR_INTERVAL_SECONDS,
+                  timeout=self.monitor_timeout, alive=self.loop_alive).start()
+        if self.health_port:
+            HealthServer(self.health_port + self.partition_number, self.current_status).start()
+
+    def start_metrics(self):
+        if not self.metrics_port:
+            return
+        # lag comes from the last status update, the scrape thread must not touch the consumer
+        self.metrics = LoaderMetrics(self.partition_number, self.decoder, self.writer, self.offsets,
+                                     lag_fn=lambda: self.status.get("consumer_lag", {}),
+                                     paused_fn=self.backpressure.is_paused, scheduler=self.scheduler,
+                                     rollup=self.pipeline.rollup, dedup=self.dedup, sinks=self.pipeline.sinks,
+                                     diverter=self.diverter)
+        self.pipeline.add_observer(self.metrics.observe)
+        for sink in self.pipeline.sinks:
+            sink.add_observer(self.metrics.observe)
+        self.metrics.start(self.metrics_port + self.partition_number)
+
+    def call_load_sql(self, consumer, asynchronous=True):
+        flushed = self.pipeline.flush(consumer, asynchronous=asynchronous)
+        if flushed and self.worker_counters is not None:
+            self.worker_counters[0] = self.offsets.committed_messages
+            self.worker_counters[1] = self.writer.rows_written
+        return flushed
+
+    def rollback(self):
+        # what was consumed since the last commit is delivered again, to us or another member
+        if self.pipeline.rollup is not None:
+            self.pipeline.rollup.rollback()
+        if self.dedup is not None:
+            self.dedup.rollback()
+
+    def on_revoke(self, consumer, partitions):
+        # Flush what we hold for these partitions before another member takes them
+        if not self.call_load_sql(consumer, asynchronous=False):
+            self.rollback()
+        self.offsets.revoke(partitions)
+
+    def consume_loop(self, consumer, topics, assignment=None):
+        writer = self.writer
+        try:
+            if assignment:
+                consumer.assign(assignment)
+            else:
+                consumer.subscribe(topics, on_revoke=self.on_revoke)
+            self.backpressure.reset()
+
+            while self.running:
+                schedule.run_pending()
+                if writer.due():
+                    self.call_load_sql(consumer)
+                self.backpressure.update(consumer, writer.pending())
+                if time.monotonic() - self.status_time >= STATUS_INTERVAL_SECONDS:
+                    self.update_status(consumer)
+
+                msgs = consumer.consume(num_messages=self.consume_batch_size, timeout=self.consume_batch_timeout)
+                if not msgs: continue
+
+                self.pipeline.process(msgs)
+        except KafkaException as e:
+            print(f"Caught Kafka exception: {str(e)}")
+            raise
+        finally:
+            # Flush and commit what was consumed, then close down the consumer.
+            try:
+                if not self.call_load_sql(consumer, asynchronous=False):
+                    self.rollback()
+            except KafkaException as e:
+                print(f"Final commit failed: {str(e)}")
+                self.rollback()
+            if self.diverter is not None:
+                self.diverter.producer.flush(5)
+            consumer.close()
+
+    def open_spool(self):
+        self.spool = Spool(f"{self.spool_directory}/{self.partition_number}", self.spool_segment_mb * 1024 * 1024)
+        self.pipeline.spool = self.spool
+        rows = self.spool.replay()
+        if rows:
+            print(f"{datetime.now()} replaying {len(rows)} spooled rows")
+            self.writer.add_many(rows)
+
+    def open_registry(self):
+        if self.registry is None:
+            return
+        self.registry.start()
+        if self.unknown_devices == 'divert':
+            self.diverter = UnknownDiverter(Producer({'bootstrap.servers': self.kafka_broker}),
+                                            self.config.get('registry', 'divert_topic', fallback='ptdata_unregistered'))
+            self.decoder.divert = self.diverter
+
+    def open_rollup(self):
+        if self.pipeline.rollup is not None:
+            self.pipeline.rollup.open_state(f"{self.spool_directory}/{self.partition_number}/rollup.state")
+
+    def open_archive(self):
+        config = self.config
+        if not config.getboolean('archive', 'enabled', fallback=False):
+            return
+        self.archive = UplinkArchive(config.get('archive', 'directory', fallback='/var/lib/packetthings/archive'),
+                                     worker=self.partition_number,
+                                     compression=config.get('archive', 'compression', fallback='zstd'),
+                                     roll_bytes=config.getint('archive', 'roll_mb', fallback=64) * 1024 * 1024,
+                                     roll_seconds=config.getint('archive', 'roll_minutes', fallback=60) * 60)
+        self.pipeline.archive = self.archive
+        self.decoder.archive = self.archive.add
+
+    def open_backlog(self):
+        config = self.config
+        if not config.getboolean('breaker', 'enabled', fallback=False):
+            return
+        writer = self.writer
+        writer.breaker = CircuitBreaker(failures=config.getint('breaker', 'failures', fallback=3),
+                                        reset_timeout=config.getfloat('breaker', 'reset_seconds', fallback=30))
+        directory = config.get('breaker', 'directory', fallback='/var/lib/packetthings/backlog')
+        writer.backlog = Backlog(f"{directory}/{self.partition_number}",
+                                 level=config.getint('breaker', 'compression_level', fallback=6))
+        writer.drain_rate = config.getint('breaker', 'drain_rows_per_second', fallback=2000)
+        writer.drain_max_rows = config.getint('breaker', 'drain_max_rows', fallback=20000)
+        if writer.backlog.segments:
+            print(f"{datetime.now()} {writer.backlog.rows()} backlog rows waiting to be drained")
+        restored = writer.restore_latest()
+        if restored:
+            print(f"{datetime.now()} {restored} latest_data rows restored from the backlog")
+
+    def _sink_policy(self, section, name):
+        config = self.config
+        spill = None
+        if config.get(section, 'overflow', fallback='drop') == 'spill':
+            spill = SpillFile(f"{self.spool_directory}/{self.partition_number}/{name}.spill",
+                              config.getint(section, 'spill_mb', fallback=256) * 1024 * 1024)
+        return {'max_rows': config.getint(section, 'max_rows', fallback=5000),
+                'max_interval': config.getfloat(section, 'max_interval', fallback=5.0),
+                'queue_batches': config.getint(section, 'queue_batches', fallback=1000),
+                'spill': spill}
+
+    def open_sinks(self):
+        config = self.config
+        sinks = []
+        if config.getboolean('sink:device_summ', 'enabled', fallback=False):
+            sinks.append(DeviceSummSink(config.get('sink:device_summ', 'dsn'),
+                                        **self._sink_policy('sink:device_summ', 'device_summ')))
+        if config.getboolean('sink:parquet', 'enabled', fallback=False):
+            sinks.append(ParquetSink(config.get('sink:parquet', 'directory', fallback='/var/lib/packetthings/measurements'),
+                                     worker=self.partition_number,
+                                     compression=config.get('sink:parquet', 'compression', fallback='zstd'),
+                                     **self._sink_policy('sink:parquet', 'parquet')))
+        if config.getboolean('sink:pubsub', 'enabled', fallback=False):
+            producer = Producer({'bootstrap.servers': self.kafka_broker,
+                                 'linger.ms': config.getint('sink:pubsub', 'linger_ms', fallback=50)})
+            sinks.append(PubSubSink(producer, config.get('sink:pubsub', 'topic', fallback='ptdata_live'),
+                                    **self._sink_policy('sink:pubsub', 'pubsub')))
+        for sink in sinks:
+            sink.registry = self.registry
+            sink.start()
+            print(f"{datetime.now()} {sink.name} sink started")
+        self.pipeline.sinks = sinks
+
+    def run(self, consumer, topics, assignment=None):
+        while self.running:
+            try:
+                self.consume_loop(consumer, topics, assignment)
+            except KafkaException as e:
+                print(f"Error occurred: {e}. Reconnecting...")
+                time.sleep(5)
+                consumer = Consumer(self.conf)
+        for sink in self.pipeline.sinks:
+            sink.close()
+        if self.archive is not None:
+            self.archive.close()
+
+    def stop(self, signum, frame):
+        self.running = False
+
+    def _start(self, partition_number):
+        self.partition_number = partition_number
+        self.open_registry()
+        # the backlog's latest_data rows go into the empty buffer, before the spool replays
+        self.open_backlog()
+        self.open_spool()
+        self.open_rollup()
+        self.open_archive()
+        self.open_sinks()
+        self.start_health()
+        self.start_metrics()
+
+    def run_worker(self, worker_id, assignment, counters):
+        """Entry point for supervisor.py: consume an explicit [(topic, partition)] assignment."""
+        topics = sorted({topic for topic, partition in assignment})
+        unknown = [topic for topic in topics if topic not in self.topics]
+        if unknown:
+            # no source decoder for them; [sources] or --topic disagree with this loader
+            raise SystemExit(f"worker {worker_id} assigned {', '.join(unknown)}, "
+                             f"but this loader consumes {', '.join(self.topics)}")
+        self._start(worker_id)
+        self.worker_counters = counters
+        signal.signal(signal.SIGTERM, self.stop)
+        print(f"{datetime.now()} worker {worker_id} assigned partitions "
+              f"{', '.join(f'{topic}/{partition}' for topic, partition in assignment)}")
+        self.run(Consumer(self.conf), topics, [TopicPartition(topic, p) for topic, p in assignment])
+
+    def main(self, partition_number):
+        self._start(partition_number)
+        print(f"{datetime.now()} worker {partition_number} consuming {', '.join(self.topics)}")
+        self.run(Consumer(self.conf), self.topics)
@@ -0,0 +1,178 @@
+import heapq
+import threading
+import time
+
+from cassandra.query import BatchStatement, SimpleStatement
+
+# Stand-ins for the Kafka consumer and the Cassandra session, used by the
+# offline benchmarks. RecordingSession keeps every statement it is given and
+# completes execute_async() futures from a background thread after `latency`
+# seconds, so execute_concurrent() sees requests in flight the way it does
+# against a real cluster.
+
+
+class FakeMessage:
+
+    def __init__(self, value, partition, offset, topic="ptdata_prod"):
+        self._value = value
+        self._partition = partition
+        self._offset = offset
+        self._topic = topic
+
+    def value(self):
+        return self._value
+
+    def topic(self):
+        return self._topic
+
+    def partition(self):
+        return self._partition
+
+    def offset(self):
+        return self._offset
+
+    def error(self):
+        return None
+
+
+class FakeConsumer:
+
+    def __init__(self, values, partitions=4, topic="ptdata_prod"):
+        self.messages = [FakeMessage(v, i % partitions, i // partitions, topic) for i, v in enumerate(values)]
+        self.position = 0
+        self.commits = 0
+
+    def poll(self, timeout=None):
+        if self.position >= len(self.messages):
+            return None
+        msg = self.messages[self.position]
+        self.position += 1
+        return msg
+
+    def consume(self, num_messages=1, timeout=None):
+        msgs = self.messages[self.position:self.position + num_messages]
+        self.position += len(msgs)
+        return msgs
+
+    def commit(self, offsets=None, asynchronous=True):
+        self.commits += 1
+
+    def assignment(self):
+        return []
+
+
+class FakePrepared(SimpleStatement):
+    """Stands in for a PreparedStatement in execute_concurrent and BatchStatement.add."""
+
+
+class FakeFuture:
+
+    def __init__(self, query, parameters):
+        self.query = query
+        self.parameters = parameters
+        self._col_names = None
+        self._col_types = None
+        self.has_more_pages = False
+        self._callbacks = []
+        self._errbacks = []
+        self._lock = threading.Lock()
+        self._done = False
+        self._error = None
+
+    def add_callbacks(self, callback, errback, callback_args=(), callback_kwargs=None,
+                      errback_args=(), errback_kwargs=None):
+        with self._lock:
+            if not self._done:
+                self._callbacks.append((callback, callback_args, callback_kwargs or {}))
+                self._errbacks.append((errback, errback_args, errback_kwargs or {}))
+                return
+        self._fire(callback, callback_args, callback_kwargs or {}, errback, errback_args, errback_kwargs or {})
+
+    def clear_callbacks(self):
+        with self._lock:
+            self._callbacks = []
+            self._errbacks = []
+
+    def _fire(self, callback, callback_args, callback_kwargs, errback, errback_args, errback_kwargs):
+        if self._error is None:
+            callback([], *callback_args, **callback_kwargs)
+        else:
+            errback(self._error, *errback_args, **errback_kwargs)
+
+    def complete(self, error=None):
+        with self._lock:
+            self._done = True
+            self._error = error
+            callbacks, errbacks = self._callbacks, self._errbacks
+            self._callbacks, self._errbacks = [], []
+        for (callback, cargs, ckwargs), (errback, eargs, ekwargs) in zip(callbacks, errbacks):
+            self._fire(callback, cargs, ckwargs, errback, eargs, ekwargs)
+
+
+class RecordingSession:
+    """A Cassandra session that records statements instead of sending them.
+
+    Every request takes `latency` seconds plus `row_latency` per statement
+    in a batch. fail_every=n fails every n-th request, to exercise the retry
+    paths.
+    """
+
+    def __init__(self, latency=0.002, fail_every=0, record=True, row_latency=0.0):
+        self.latency = latency
+        self.row_latency = row_latency
+        self.fail_every = fail_every
+        self.record = record
+        self.statements = []
+        self.requests = 0
+        self._pending = []
+        self._counter = 0
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._complete, name="fake-cassandra", daemon=True)
+        self._thread.start()
+
+    def prepare(self, query):
+        return FakePrepared(query.replace("?", "%s"))
+
+    def _latency(self, query):
+        if isinstance(query, BatchStatement):
+            return self.latency + self.row_latency * len(query._statements_and_parameters)
+        return self.latency
+
+    def _error(self):
+        self.requests += 1
+        if self.fail_every and self.requests % self.fail_every == 0:
+            return Exception("simulated write timeout")
+        return None
+
+    def execute(self, query, parameters=None, **kwargs):
+        if self.record:
+            self.statements.append((query, parameters))
+        error = self._error()
+        time.sleep(self._latency(query))
+        if error is not None:
+            raise error
+        return []
+
+    def execute_async(self, query, parameters=None, **kwargs):
+        if self.record:
+            self.statements.append((query, parameters))
+        future = FakeFuture(query, parameters)
+        error = self._error()
+        with self._condition:
+            self._counter += 1
+            heapq.heappush(self._pending, (time.monotonic() + self._latency(query), self._counter, future, error))
+            self._condition.notify()
+        return future
+
+    def _complete(self):
+        while True:
+            with self._condition:
+                while not self._pending:
+                    self._condition.wait()
+                due, _, future, error = self._pending[0]
+                wait = due - time.monotonic()
+                if wait > 0:
+                    self._condition.wait(wait)
+                    continue
+                heapq.heappop(self._pending)
+            future.complete(error)
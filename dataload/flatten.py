@@ -0,0 +1,121 @@
+from operator import itemgetter
+
+NUMBERS = (int, float)
+MAX_DEPTH = 4  # levels of nested objects followed below decoded_payload
+
+
+class ShapePlan:
+    """What to take out of one decoded_payload shape.
+
+    get is an itemgetter over the mapped top-level keys (None when there
+    are none) returning their values as a tuple, in the order of
+    measurements. nested is a tuple of (path, measurement) for the numeric
+    fields of nested objects. unmapped is the number of numeric fields of
+    the shape without a measurement, counted when the plan was compiled.
+    """
+
+    __slots__ = ("get", "measurements", "nested", "unmapped")
+
+    def __init__(self, get, measurements, nested, unmapped):
+        self.get = get
+        self.measurements = measurements
+        self.nested = nested
+        self.unmapped = unmapped
+
+
+def shape_of(values, depth=0):
+    """The key set of a decoded_payload, with the key sets of the nested objects followed by the plans.
+
+    Two payloads with the same shape compile to the same plan: a key that
+    turns from a number into an object, or a nested object that gains a
+    key, makes another shape.
+    """
+    if dict not in map(type, values.values()):
+        # the usual flat payload, checked without a Python-level loop
+        return frozenset(values)
+    nested = [(key, shape_of(value, depth + 1) if depth < MAX_DEPTH else None)
+              for key, value in values.items() if type(value) is dict]
+    return frozenset(values), frozenset(nested)
+
+
+class PayloadFlattener:
+    """Caches an extraction plan per (application_id, decoded_payload shape).
+
+    Devices of one application send the same keys message after message, so
+    the measurement lookups and type checks of the keys are done once per
+    shape (see shape_of()); a repeated shape costs building its frozensets
+    and one dict lookup. Nested
+    objects are flattened to dotted paths ("a.b.c") that are mapped through
+    the MeasurementMap like any other key, so nested numeric fields are
+    written once measurements.ini names them instead of being dropped.
+
+    Plans are rebuilt when the measurement map reloads; refresh() checks
+    for that and is called once per batch.
+    """
+
+    MAX_SHAPES = 10000
+
+    def __init__(self, measurements):
+        self.measurements = measurements
+        self.reloads = measurements.reloads
+        self.plans = {}
+        self.compiled = 0
+
+    def refresh(self):
+        if self.measurements.reloads != self.reloads:
+            self.reloads = self.measurements.reloads
+            self.plans = {}
+
+    def plan(self, application_id, decoded):
+        shape = (application_id, shape_of(decoded))
+        plan = self.plans.get(shape)
+        if plan is None:
+            plan = self._compile(application_id, decoded)
+            if len(self.plans) >= self.MAX_SHAPES:
+                self.plans = {}
+            self.plans[shape] = plan
+        return plan
+
+    def _compile(self, application_id, decoded):
+        keys = self.measurements.for_application(application_id)
+        flat_keys = []
+        measurements = []
+        nested = []
+        unmapped = 0
+        for key, value in decoded.items():
+            if isinstance(value, dict):
+                unmapped += self._compile_nested(keys, (key,), value, nested)
+                continue
+            measurement = keys[key]
+            if measurement is not None:
+                # kept whatever the value is now, the type is checked per message
+                flat_keys.append(key)
+                measurements.append(measurement)
+            elif isinstance(value, NUMBERS):
+                unmapped += 1
+        if not flat_keys:
+            get = None
+        elif len(flat_keys) == 1:
+            # itemgetter of one key returns the bare value, not a tuple
+            def get(decoded, key=flat_keys[0]):
+                return (decoded[key],)
+        else:
+            get = itemgetter(*flat_keys)
+        self.compiled += 1
+        return ShapePlan(get, tuple(measurements), tuple(nested), unmapped)
+
+    def _compile_nested(self, keys, path, values, nested):
+        if len(path) > MAX_DEPTH:
+            return 0
+        unmapped = 0
+        for key, value in values.items():
+            if isinstance(value, dict):
+                unmapped += self._compile_nested(keys, path + (key,), value, nested)
+                continue
+            measurement = keys[".".join(path + (key,))]
+            if measurement is not None:
+                # like top-level keys, the type is checked per message
+                nested.append((path + (key,), measurement))
+            elif isinstance(value, NUMBERS):
+                unmapped += 1
+        return unmapped
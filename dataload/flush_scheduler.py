@@ -0,0 +1,73 @@
+import time
+
+# Weight of the newest sample in the rate and write-cost averages.
+SMOOTHING = 0.3
+
+
+class FlushScheduler:
+    """Adapts the writer's flush interval to the incoming rate and write cost.
+
+    Two targets: size_target rows per flush, and latency_target seconds
+    for the oldest buffered row to reach Cassandra. A full size_target
+    buffer is flushed at once (writer.flush_rows). Otherwise the row that
+    arrived first waits one interval plus the flush itself, and a flush of
+    interval * rate rows takes interval * rate * write_cost seconds, so
+
+        interval = latency_target / (1 + rate * write_cost)
+
+    kept within [min_interval, max_interval]. At night that flushes a few
+    rows every latency_target seconds instead of waiting out the old fixed
+    interval; at peak the size target keeps flushes from growing without
+    bound. rate is a moving average taken at every flush, write_cost one
+    taken at the flushes that wrote to Cassandra (writer.last_flush_wrote),
+    so failed and spilled flushes don't count.
+
+    observe() is a Pipeline observe hook; `decision` says what set the
+    current interval ("latency", "min" or "max") and `triggers` counts
+    flushes by cause ("size" or "interval"), for metrics.
+    """
+
+    def __init__(self, writer, min_interval=1.0, max_interval=15.0, latency_target=5.0, size_target=5000):
+        self.writer = writer
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.latency_target = latency_target
+        self.size_target = min(size_target, writer.max_rows)
+
+        self.rate = 0.0  # rows/s coming in
+        self.write_cost = 0.0  # seconds per row written
+        self.buffered = 0
+        self.since = time.monotonic()
+        self.decision = "latency"
+        self.decisions = {"latency": 0, "min": 0, "max": 0}
+        self.triggers = {"size": 0, "interval": 0}
+
+        writer.flush_rows = self.size_target
+        writer.interval = min(max(latency_target, min_interval), max_interval)
+
+    def observe(self, stage, seconds, size):
+        if stage == "buffer":
+            self.buffered += size
+        elif stage == "flush":
+            self._flushed(seconds, size)
+
+    def _flushed(self, seconds, rows):
+        now = time.monotonic()
+        elapsed = now - self.since
+        if elapsed > 0:
+            self.rate += SMOOTHING * (self.buffered / elapsed - self.rate)
+        if rows and self.writer.last_flush_wrote:
+            self.write_cost += SMOOTHING * (seconds / rows - self.write_cost)
+        self.buffered = 0
+        self.since = now
+        self.triggers["size" if rows >= self.writer.flush_rows else "interval"] += 1
+
+        interval = self.latency_target / (1 + self.rate * self.write_cost)
+        if interval <= self.min_interval:
+            interval, self.decision = self.min_interval, "min"
+        elif interval >= self.max_interval:
+            interval, self.decision = self.max_interval, "max"
+        else:
+            self.decision = "latency"
+        self.decisions[self.decision] += 1
+        self.writer.interval = interval
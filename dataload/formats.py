@@ -0,0 +1,26 @@
+import json
+import os
+
+try:
+    import pyarrow.parquet as pq
+except ImportError:
+    pq = None
+
+try:
+    import orjson
+    fast_dumps = orjson.dumps
+except ImportError:
+    def fast_dumps(document):
+        return json.dumps(document, default=str).encode("utf-8")
+
+# Encodings shared by the loader's outputs: fast_dumps() is JSON as bytes,
+# with orjson when it is installed, for Kafka messages and archived
+# payloads; write_parquet() writes the Parquet files of the archive and the
+# Parquet sink.
+
+
+def write_parquet(path, table, compression):
+    # written under a temporary name so readers never see half a file
+    temporary = path + ".tmp"
+    pq.write_table(table, temporary, compression=compression)
+    os.replace(temporary, path)
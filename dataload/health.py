@@ -0,0 +1,108 @@
+import json
+import threading
+import time
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests as req
+from confluent_kafka import OFFSET_INVALID
+
+
+def consumer_lag(consumer):
+    """{topic: {partition: messages behind the high watermark}} for the current assignment.
+
+    Uses the watermarks librdkafka caches from fetch responses, so it does not
+    block on the broker; call it from the consume loop, not another thread.
+    """
+    lag = {}
+    assignment = consumer.assignment()
+    if not assignment:
+        return lag
+    for tp in consumer.position(assignment):
+        low, high = consumer.get_watermark_offsets(tp, cached=True)
+        if high < 0:
+            continue
+        position = tp.offset if tp.offset != OFFSET_INVALID else low
+        lag.setdefault(tp.topic, {})[tp.partition] = max(0, high - position)
+    return lag
+
+
+class Heartbeat:
+    """Pings the monitor URLs from a background thread.
+
+    Every request has a timeout, so a slow monitor can only delay the next
+    heartbeat, never the consume loop. alive() is checked first: when the
+    loop has stopped updating its status the pings stop as well, so the
+    monitors notice a stuck worker.
+    """
+
+    def __init__(self, urls, interval=60, timeout=5, retries=2, alive=None):
+        self.urls = [url for url in urls if url]
+        self.interval = interval
+        self.timeout = timeout
+        self.retries = retries
+        self.alive = alive
+        self.last_ok = {}
+        self.failures = 0
+        self.thread = threading.Thread(target=self._run, name="heartbeat", daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            if self.alive is None or self.alive():
+                for url in self.urls:
+                    self._ping(url)
+            time.sleep(self.interval)
+
+    def _ping(self, url):
+        for attempt in range(self.retries + 1):
+            try:
+                req.get(url, timeout=self.timeout)
+                self.last_ok[url] = datetime.now()
+                return
+            except req.RequestException:
+                pass
+        self.failures += 1
+        print(f"{datetime.now()} Could not reach {url}")
+
+
+class HealthServer:
+    """Serves the loader's status on a local port.
+
+    GET /health answers 200 while status_fn() reports healthy, 503 otherwise,
+    with degraded set when the loader runs but cannot write (circuit breaker);
+    GET /status returns the whole status document as JSON.
+    """
+
+    def __init__(self, port, status_fn, host="127.0.0.1"):
+        status = status_fn
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                document = status()
+                if self.path == "/health":
+                    code = 200 if document.get("healthy") else 503
+                    body = {"healthy": document.get("healthy"), "degraded": document.get("degraded", False)}
+                elif self.path == "/status":
+                    code, body = 200, document
+                else:
+                    code, body = 404, {"error": "not found"}
+                data = json.dumps(body, default=str).encode("utf-8")
+                self.send_response(code)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, name="health", daemon=True)
+
+    def start(self):
+        self.thread.start()
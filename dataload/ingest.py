@@ -0,0 +1,134 @@
+import logging
+import time
+from datetime import datetime
+
+from confluent_kafka import KafkaError, KafkaException
+
+logger = logging.getLogger()
+
+
+class Pipeline:
+    """The path from a batch of consumed Kafka messages to committed offsets.
+
+    process() decodes a batch, one decode_batch() call per topic in it so
+    every topic goes through its own source decoder, spools the rows,
+    buffers them in the writer, offers them to the sinks (see sinks.py) and
+    marks the offsets as processed. flush() writes the buffer and, once
+    that succeeded, writes the optional archive.UplinkArchive, checkpoints
+    the optional rollup.HourlyRollup, commits the offsets, checkpoints the
+    decoder's dedup.RecentUplinks, rotates the spool and writes the closed
+    hours of the rollup. Observers
+    (observe and those added with add_observer) are called as
+    observer(stage, seconds, size) for the "decode", "buffer", "flush",
+    "archive" and "rollup" stages.
+    """
+
+    def __init__(self, decoder, writer, offsets, spool=None, observe=None, rollup=None, archive=None, sinks=None):
+        self.decoder = decoder
+        self.writer = writer
+        self.offsets = offsets
+        self.spool = spool
+        self.rollup = rollup
+        self.archive = archive
+        self.sinks = list(sinks or [])
+        self.observers = [observe] if observe else []
+
+    def add_observer(self, observe):
+        self.observers.append(observe)
+
+    def observe(self, stage, seconds, size):
+        for observe in self.observers:
+            observe(stage, seconds, size)
+
+    def process(self, msgs):
+        topics = {}  # topic: ([values], [(partition, offset)])
+        consumed = []
+        error = None
+        for msg in msgs:
+            if msg.error():
+                if msg.error().code() == KafkaError._PARTITION_EOF:
+                    # End of partition event
+                    logger.info('%% %s [%d] reached end at offset %d\n' %
+                                (msg.topic(), msg.partition(), msg.offset()))
+                    continue
+                error = msg.error()
+                break
+            topic = msg.topic()
+            batch = topics.get(topic)
+            if batch is None:
+                batch = topics[topic] = ([], [])
+            batch[0].append(msg.value())
+            batch[1].append((msg.partition(), msg.offset()))
+            consumed.append(msg)
+
+        start = time.perf_counter()
+        if len(topics) <= 1:
+            # an empty batch still picks up recovered quarantine documents
+            topic, (values, positions) = topics.popitem() if topics else (None, ([], []))
+            rows = self.decoder.decode_batch(values, topic, positions)
+        else:
+            rows = []
+            for topic, (values, positions) in topics.items():
+                rows.extend(self.decoder.decode_batch(values, topic, positions))
+        decoded = time.perf_counter()
+        if self.spool is not None:
+            self.spool.append(rows)
+        self.writer.add_many(rows)
+        if self.rollup is not None:
+            self.rollup.add_many(rows)
+        for sink in self.sinks:
+            sink.offer(rows)
+        for msg in consumed:
+            self.offsets.processed(msg.topic(), msg.partition(), msg.offset())
+        self.observe("decode", decoded - start, len(consumed))
+        self.observe("buffer", time.perf_counter() - decoded, len(rows))
+
+        if error:
+            raise KafkaException(error)
+        return rows
+
+    def flush(self, consumer, asynchronous=True):
+        pending = self.writer.pending()
+        start = time.perf_counter()
+        flushed = self.writer.flush()
+        if pending:
+            self.observe("flush", time.perf_counter() - start, pending)
+        if flushed and self.archive is not None:
+            flushed = self._flush_archive()
+        if flushed and self.rollup is not None:
+            flushed = self._checkpoint_rollup()
+        if flushed:
+            self.offsets.commit(consumer, asynchronous=asynchronous)
+            if self.decoder.dedup is not None:
+                self.decoder.dedup.checkpoint()
+            if self.spool is not None:
+                self.spool.rotate()
+            if self.rollup is not None:
+                start = time.perf_counter()
+                written = self.rollup.flush()
+                if written:
+                    self.observe("rollup", time.perf_counter() - start, written)
+        return flushed
+
+    def _checkpoint_rollup(self):
+        try:
+            self.rollup.checkpoint()
+        except OSError as e:
+            # the rollup state has to be on disk before the offsets it covers are committed
+            print(f"{datetime.now()} rollup checkpoint failed: {e}")
+            return False
+        return True
+
+    def _flush_archive(self):
+        pending = self.archive.pending()
+        if not pending:
+            return True
+        start = time.perf_counter()
+        try:
+            self.archive.flush()
+        except OSError as e:
+            # offsets stay uncommitted until the archive is on disk as well
+            print(f"{datetime.now()} archive flush failed, {pending} uplinks kept: {e}")
+            return False
+        self.observe("archive", time.perf_counter() - start, pending)
+        return True
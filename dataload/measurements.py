@@ -0,0 +1,90 @@
+import configparser
+import os
+
+
+class ApplicationKeys(dict):
+    """raw decoded_payload key -> measurement for one application_id.
+
+    Filled on first lookup of each key, so the decoder's lookups are plain
+    dict hits. A key that maps to nothing is cached as None.
+    """
+
+    def __init__(self, measurements, application_id):
+        super().__init__()
+        self.measurements = measurements
+        self.application_id = application_id
+
+    def __missing__(self, key):
+        measurement = self.measurements.resolve(self.application_id, key)
+        if len(self) < self.measurements.MAX_KEYS:
+            self[key] = measurement
+        return measurement
+
+
+class MeasurementMap:
+    """Maps decoded_payload keys to measurement names, case-insensitively.
+
+    defaults is the loader's built-in payload_dict. path is an ini file that
+    adds to it: a [measurements] section for all applications and
+    [app:<application_id>] sections that override it for one application.
+    An empty value unmaps a key. The file is re-read by reload_if_changed()
+    when its mtime changes, without restarting the loader.
+    """
+
+    MAX_KEYS = 10000
+
+    def __init__(self, defaults, path="measurements.ini"):
+        self.defaults = {key.lower(): value for key, value in defaults.items()}
+        self.path = path
+        self.mtime = None
+        self.common = dict(self.defaults)
+        self.overrides = {}
+        self.applications = {}
+        self.reloads = 0
+        self.reload_if_changed()
+
+    def for_application(self, application_id):
+        keys = self.applications.get(application_id)
+        if keys is None:
+            keys = self.applications[application_id] = ApplicationKeys(self, application_id)
+        return keys
+
+    def resolve(self, application_id, key):
+        key = key.lower()
+        overrides = self.overrides.get(application_id)
+        if overrides is not None and key in overrides:
+            return overrides[key] or None
+        return self.common.get(key) or None
+
+    def reload_if_changed(self):
+        if not self.path:
+            return
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except OSError:
+            mtime = None
+        if mtime == self.mtime:
+            return
+        self.mtime = mtime
+
+        common = dict(self.defaults)
+        overrides = {}
+        if mtime is not None:
+            parser = configparser.ConfigParser()
+            try:
+                parser.read(self.path)
+            except configparser.Error as e:
+                print(f"Could not reload {self.path}: {e}")
+                return
+            for section in parser.sections():
+                if section == "measurements":
+                    common.update(parser.items(section))
+                elif section.startswith("app:"):
+                    overrides[section[4:]] = dict(parser.items(section))
+
+        self.common = common
+        self.overrides = overrides
+        # Loaders pick up fresh per-application caches on their next message.
+        self.applications = {}
+        self.reloads += 1
+        print(f"Loaded measurement map from {self.path}: {len(common)} keys, {len(overrides)} application overrides")
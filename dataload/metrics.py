@@ -0,0 +1,236 @@
+try:
+    from prometheus_client import CollectorRegistry, Histogram, start_http_server
+    from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+except ImportError:
+    CollectorRegistry = None
+
+from breaker import CLOSED, HALF_OPEN, OPEN
+
+# Latency buckets in seconds, from a small decode batch up to a slow flush.
+SECONDS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+SIZE_BUCKETS = (1, 10, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 25000, 50000)
+
+
+class LoaderMetrics:
+    """Prometheus metrics for one loader process, served on a local port.
+
+    Counters and gauges are read from the components' own counters when
+    Prometheus scrapes, so the consume loop pays nothing for them; only the
+    histograms are fed, once per batch, through observe(), the Pipeline
+    observe hook. lag_fn returns the {topic: {partition: lag}} the consume
+    loop last measured (consumer_lag() must not be called from the scrape
+    thread).
+
+    Without prometheus_client installed start() says so and observe() does
+    nothing. The decoder's quarantine counters are exported when it has
+    one. With a FlushScheduler its interval, estimates and decisions are
+    exported as well, and the counters of an HourlyRollup, a RecentUplinks
+    dedup and a registry.UnknownDiverter when given. Each of the sinks (see
+    sinks.py) gets its write time, queue delay and batch size histograms,
+    fed from the sink thread, and its counters labelled with the sink name.
+    A writer with a circuit breaker adds its state and the backlog's
+    spilled, drained and waiting rows.
+    """
+
+    def __init__(self, worker, decoder, writer, offsets, lag_fn=None, paused_fn=None, scheduler=None,
+                 rollup=None, dedup=None, sinks=(), diverter=None):
+        self.worker = str(worker)
+        self.decoder = decoder
+        self.writer = writer
+        self.offsets = offsets
+        self.lag_fn = lag_fn or dict
+        self.paused_fn = paused_fn
+        self.scheduler = scheduler
+        self.rollup = rollup
+        self.dedup = dedup
+        self.diverter = diverter
+        self.sinks = list(sinks)
+        self.registry = None
+        self.histograms = {}
+        if CollectorRegistry is None:
+            return
+
+        self.registry = CollectorRegistry()
+        self.decode_seconds = Histogram("loader_decode_seconds", "Time to decode one consumed batch",
+                                        ["worker"], buckets=SECONDS_BUCKETS, registry=self.registry)
+        self.buffer_seconds = Histogram("loader_buffer_seconds", "Time to spool and buffer one decoded batch",
+                                        ["worker"], buckets=SECONDS_BUCKETS, registry=self.registry)
+        self.flush_seconds = Histogram("loader_flush_seconds", "Time to write one flush to Cassandra",
+                                       ["worker"], buckets=SECONDS_BUCKETS, registry=self.registry)
+        self.batch_messages = Histogram("loader_batch_messages", "Messages per Consumer.consume() batch",
+                                        ["worker"], buckets=SIZE_BUCKETS, registry=self.registry)
+        self.rollup_seconds = Histogram("loader_rollup_seconds", "Time to merge and write the closed hours",
+                                        ["worker"], buckets=SECONDS_BUCKETS, registry=self.registry)
+        self.archive_seconds = Histogram("loader_archive_seconds", "Time to write the archive part files",
+                                         ["worker"], buckets=SECONDS_BUCKETS, registry=self.registry)
+        self.flush_rows = Histogram("loader_flush_rows", "Rows per flush",
+                                    ["worker"], buckets=SIZE_BUCKETS, registry=self.registry)
+        self.histograms = {
+            "decode": (self.decode_seconds.labels(self.worker), self.batch_messages.labels(self.worker)),
+            "buffer": (self.buffer_seconds.labels(self.worker), None),
+            "flush": (self.flush_seconds.labels(self.worker), self.flush_rows.labels(self.worker)),
+            "rollup": (self.rollup_seconds.labels(self.worker), None),
+            "archive": (self.archive_seconds.labels(self.worker), None),
+        }
+        if self.sinks:
+            self.sink_write_seconds = Histogram("loader_sink_write_seconds", "Time for a sink to write one batch",
+                                                ["worker", "sink"], buckets=SECONDS_BUCKETS, registry=self.registry)
+            self.sink_delay_seconds = Histogram("loader_sink_delay_seconds",
+                                                "Time the oldest row of a sink batch waited in its queue",
+                                                ["worker", "sink"], buckets=SECONDS_BUCKETS, registry=self.registry)
+            self.sink_rows = Histogram("loader_sink_batch_rows", "Rows per sink write",
+                                       ["worker", "sink"], buckets=SIZE_BUCKETS, registry=self.registry)
+            for sink in self.sinks:
+                self.histograms[f"sink_write:{sink.name}"] = (self.sink_write_seconds.labels(self.worker, sink.name),
+                                                              self.sink_rows.labels(self.worker, sink.name))
+                self.histograms[f"sink_delay:{sink.name}"] = (self.sink_delay_seconds.labels(self.worker, sink.name),
+                                                              None)
+        self.registry.register(self)
+
+    def observe(self, stage, seconds, size):
+        histograms = self.histograms.get(stage)
+        if histograms is None:
+            return
+        latency, sizes = histograms
+        latency.observe(seconds)
+        if sizes is not None:
+            sizes.observe(size)
+
+    def start(self, port, host="127.0.0.1"):
+        if self.registry is None:
+            print("prometheus_client is not installed, metrics are disabled")
+            return
+        start_http_server(port, addr=host, registry=self.registry)
+
+    def _counter(self, name, documentation, value):
+        family = CounterMetricFamily(name, documentation, labels=["worker"])
+        family.add_metric([self.worker], value)
+        return family
+
+    def _gauge(self, name, documentation, value):
+        family = GaugeMetricFamily(name, documentation, labels=["worker"])
+        family.add_metric([self.worker], value)
+        return family
+
+    def collect(self):
+        decoder = self.decoder
+        writer = self.writer
+        yield self._counter("loader_messages", "Kafka messages decoded", decoder.messages)
+        yield self._counter("loader_rows_decoded", "Measurement rows decoded", decoder.rows)
+        yield self._counter("loader_rows_written", "Rows written to device_data", writer.rows_written)
+        yield self._counter("loader_latest_rows_written", "Rows written to latest_data", writer.latest_written)
+        yield self._counter("loader_latest_rows_coalesced",
+                            "Rows that did not need a latest_data write because a newer one was in the same flush",
+                            writer.latest_coalesced)
+        yield self._counter("loader_unmapped_keys", "Numeric decoded_payload keys without a measurement",
+                            decoder.unmapped)
+        yield self._counter("loader_parse_failures", "Kafka values that were not valid JSON",
+                            decoder.parse_failures)
+        yield self._counter("loader_unknown_devices", "Uplinks from devices missing from the registry",
+                            decoder.unknown)
+        yield self._counter("loader_skipped_messages", "Messages without the fields a row needs",
+                            decoder.skipped)
+        yield self._counter("loader_failed_flushes", "Flushes that left rows for the next one",
+                            writer.failed_flushes)
+        yield self._counter("loader_commits", "Offset commits after a successful flush",
+                            self.offsets.commit_count)
+        yield self._gauge("loader_buffered_rows", "Rows waiting for the next flush", writer.pending())
+        if self.paused_fn is not None:
+            yield self._gauge("loader_paused", "1 while consumption is paused by backpressure",
+                              1 if self.paused_fn() else 0)
+
+        quarantine = decoder.quarantine
+        if quarantine is not None:
+            yield self._counter("loader_quarantine_received", "Values handed to the quarantine", quarantine.received)
+            yield self._counter("loader_quarantine_recovered", "Quarantined values recovered as documents",
+                                quarantine.recovered_count)
+            yield self._counter("loader_quarantine_rejected", "Quarantined values that could not be recovered",
+                                quarantine.rejected)
+            yield self._counter("loader_quarantine_dropped", "Values dropped because the quarantine was full",
+                                quarantine.dropped)
+            yield self._gauge("loader_quarantine_pending", "Values waiting in the quarantine", quarantine.pending())
+        if self.diverter is not None:
+            yield self._counter("loader_unknown_diverted", "Uplinks of unregistered devices sent to the divert topic",
+                                self.diverter.diverted)
+            yield self._counter("loader_unknown_divert_dropped",
+                                "Uplinks of unregistered devices dropped because the producer queue was full",
+                                self.diverter.dropped)
+        if self.dedup is not None:
+            yield self._counter("loader_dedup_checked", "Uplinks checked for duplicates", self.dedup.checked)
+            yield self._counter("loader_dedup_hits", "Duplicate uplinks dropped", self.dedup.hits)
+            yield self._gauge("loader_dedup_entries", "Uplinks remembered for duplicate checks", len(self.dedup))
+        if self.scheduler is not None:
+            yield from self._scheduler_metrics(self.scheduler)
+        if self.rollup is not None:
+            yield self._counter("loader_rollups_written", "hourly_partials rows written", self.rollup.rollups_written)
+            yield self._counter("loader_rollups_merged", "hourly_data rows recomputed from their partials",
+                                self.rollup.rollups_merged)
+            yield self._counter("loader_rollup_late_rows", "Rows for an hour that was already written",
+                                self.rollup.late_rows)
+            yield self._gauge("loader_rollups_pending", "Open hourly accumulators", self.rollup.pending())
+
+        if writer.breaker is not None:
+            yield from self._breaker_metrics(writer)
+        if self.sinks:
+            yield from self._sink_metrics()
+
+        lag = GaugeMetricFamily("loader_consumer_lag", "Messages behind the high watermark",
+                                labels=["worker", "topic", "partition"])
+        for topic, partitions in sorted(self.lag_fn().items()):
+            for partition, behind in sorted(partitions.items()):
+                lag.add_metric([self.worker, topic, str(partition)], behind)
+        yield lag
+
+    def _breaker_metrics(self, writer):
+        breaker, backlog = writer.breaker, writer.backlog
+        state = GaugeMetricFamily("loader_breaker_state", "1 for the circuit breaker's current state",
+                                  labels=["worker", "state"])
+        for name in (CLOSED, OPEN, HALF_OPEN):
+            state.add_metric([self.worker, name], 1 if breaker.state == name else 0)
+        yield state
+        yield self._counter("loader_breaker_opens", "Times the circuit breaker opened", breaker.opens)
+        yield self._counter("loader_breaker_probes", "Half-open probes of Cassandra", breaker.probes)
+        yield self._counter("loader_backlog_rows_spilled", "Rows spilled to the backlog while the breaker was open",
+                            writer.spilled_rows)
+        yield self._counter("loader_backlog_rows_drained", "Backlog rows written to device_data",
+                            writer.drained_rows)
+        yield self._gauge("loader_backlog_rows", "Rows waiting in backlog segments", backlog.rows())
+        yield self._counter("loader_backlog_bytes_written", "Compressed bytes written to backlog segments",
+                            backlog.bytes_written)
+
+    def _sink_metrics(self):
+        counters = (
+            ("loader_sink_rows_offered", "Rows offered to a sink", "offered"),
+            ("loader_sink_rows_written", "Rows a sink wrote", "rows_written"),
+            ("loader_sink_rows_dropped", "Rows a sink dropped when full or failing", "dropped"),
+            ("loader_sink_rows_spilled", "Rows a sink spilled to disk when full or failing", "spilled"),
+            ("loader_sink_failed_writes", "Sink writes that failed", "failed_writes"),
+        )
+        for name, documentation, attribute in counters:
+            family = CounterMetricFamily(name, documentation, labels=["worker", "sink"])
+            for sink in self.sinks:
+                family.add_metric([self.worker, sink.name], getattr(sink, attribute))
+            yield family
+        depth = GaugeMetricFamily("loader_sink_queue_batches", "Batches waiting in a sink queue",
+                                  labels=["worker", "sink"])
+        for sink in self.sinks:
+            depth.add_metric([self.worker, sink.name], sink.depth())
+        yield depth
+
+    def _scheduler_metrics(self, scheduler):
+        yield self._gauge("loader_flush_interval_seconds", "Current flush interval", self.writer.interval)
+        yield self._gauge("loader_flush_size_target_rows", "Rows at which a flush starts at once",
+                          self.writer.flush_rows)
+        yield self._gauge("loader_incoming_rows_per_second", "Moving average of the rows buffered per second",
+                          scheduler.rate)
+        yield self._gauge("loader_write_seconds_per_row", "Moving average of the flush time per row",
+                          scheduler.write_cost)
+        decisions = CounterMetricFamily("loader_flush_interval_decisions",
+                                        "Interval updates by what bounded them", labels=["worker", "decision"])
+        for decision, count in scheduler.decisions.items():
+            decisions.add_metric([self.worker, decision], count)
+        yield decisions
+        triggers = CounterMetricFamily("loader_flush_triggers", "Flushes by cause", labels=["worker", "trigger"])
+        for trigger, count in scheduler.triggers.items():
+            triggers.add_metric([self.worker, trigger], count)
+        yield triggers
@@ -0,0 +1,102 @@
+import queue
+import threading
+from ast import literal_eval
+from collections import deque
+
+
+class Quarantine:
+    """Off-path handling for Kafka values that are not valid JSON.
+
+    Some producers send Python dict reprs (None, single quotes) instead of
+    JSON. literal_eval is far slower than a JSON parser and should not see
+    arbitrary input, so those values are queued here and evaluated on a
+    background thread, with a size cap. Recovered documents are handed back
+    to the decoder through drain() on its next batch. When the queue is full
+    new values are dropped and counted.
+
+    Values put with their Kafka (partition, offset) are waiting until they
+    are drained or rejected; oldest() gives the CommitManager the lowest
+    waiting offset of a partition, so the commit stays below a document
+    that is still in here and a restart reads it again.
+    """
+
+    MAX_VALUE_BYTES = 65536
+
+    def __init__(self, maxsize=10000):
+        self.queue = queue.Queue(maxsize)
+        self.recovered = deque()
+        self.rejected_samples = deque(maxlen=10)
+        self.lock = threading.Lock()
+        self.waiting = {}  # (topic, partition): {offset}
+
+        self.received = 0
+        self.recovered_count = 0
+        self.rejected = 0
+        self.dropped = 0
+
+        self.thread = threading.Thread(target=self._run, name="quarantine", daemon=True)
+        self.thread.start()
+
+    def put(self, value, topic=None, position=None):
+        """Queues a value; position is its Kafka (partition, offset), if known."""
+        self.received += 1
+        if position is not None:
+            # registered first: the thread may reject the value as soon as it is queued
+            with self.lock:
+                self.waiting.setdefault((topic, position[0]), set()).add(position[1])
+        try:
+            self.queue.put_nowait((topic, value, position))
+        except queue.Full:
+            self.dropped += 1
+            self._release(topic, position)
+
+    def drain(self):
+        """Recovered (topic, document) pairs; the caller buffers their rows before the next commit."""
+        documents = []
+        while self.recovered:
+            topic, data, position = self.recovered.popleft()
+            documents.append((topic, data))
+            self._release(topic, position)
+        return documents
+
+    def oldest(self, topic, partition):
+        """The lowest offset of the partition still waiting in here, or None."""
+        with self.lock:
+            offsets = self.waiting.get((topic, partition))
+            return min(offsets) if offsets else None
+
+    def _release(self, topic, position):
+        if position is None:
+            return
+        with self.lock:
+            offsets = self.waiting.get((topic, position[0]))
+            if offsets is not None:
+                offsets.discard(position[1])
+                if not offsets:
+                    del self.waiting[(topic, position[0])]
+
+    def pending(self):
+        return self.queue.qsize()
+
+    def _run(self):
+        while True:
+            topic, value, position = self.queue.get()
+            if len(value) > self.MAX_VALUE_BYTES:
+                self._reject(topic, value, position)
+                continue
+            try:
+                data = literal_eval(value.decode("utf-8"))
+            except (ValueError, SyntaxError, TypeError, UnicodeDecodeError, MemoryError, RecursionError):
+                self._reject(topic, value, position)
+                continue
+            if not isinstance(data, dict):
+                self._reject(topic, value, position)
+                continue
+            self.recovered.append((topic, data, position))
+            self.recovered_count += 1
+
+    def _reject(self, topic, value, position):
+        # a value that will never parse must not hold the partition back
+        self.rejected += 1
+        self.rejected_samples.append(value[:200])
+        self._release(topic, position)
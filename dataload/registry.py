@@ -0,0 +1,158 @@
+import threading
+import time
+from collections import namedtuple
+from datetime import datetime
+
+try:
+    import psycopg2
+except ImportError:
+    psycopg2 = None
+
+from formats import fast_dumps
+
+Device = namedtuple("Device", "device_id type_id location_id")
+
+# One row per device; type_id from devices, else from the user's mydevices
+# entry. updated is the later of the two, for the incremental refresh.
+DEVICES_QUERY = """
+    SELECT d.dev_eui, d.id, COALESCE(d.type_id, m.type_id), d.location_id,
+           GREATEST(d.updated, m.updated)
+    FROM devices d LEFT JOIN mydevices m ON m.device_id = d.id
+"""
+CHANGED_FILTER = " WHERE GREATEST(d.updated, m.updated) >= %s"
+
+
+class DeviceRegistry:
+    """In-process copy of the packetthings devices/mydevices tables.
+
+    load() reads every device in one query; a background thread then
+    re-reads the devices whose `updated` is at least the newest one seen
+    every refresh seconds, and reloads everything every full_refresh
+    seconds so deleted devices disappear as well. get(dev_eui) is a dict
+    lookup returning a Device(device_id, type_id, location_id) or None.
+    Rows keep the device_data layout; the sinks and the hourly rollup look
+    up (type_id, location_id) with enrichment() when they write.
+
+    Until a load has succeeded every device counts as known, so a
+    PostgreSQL outage at startup does not make the loaders drop everything.
+    """
+
+    def __init__(self, dsn, refresh=60, full_refresh=3600, timeout=10):
+        if psycopg2 is None:
+            raise RuntimeError("the device registry needs psycopg2")
+        self.dsn = dsn
+        self.refresh = refresh
+        self.full_refresh = full_refresh
+        self.timeout = timeout
+        self.devices = {}
+        self.loaded = False
+        self.newest = None
+        self.last_full = 0.0
+
+        self.loads = 0
+        self.refreshes = 0
+        self.changed = 0
+        self.failures = 0
+        self.thread = threading.Thread(target=self._run, name="registry", daemon=True)
+
+    def get(self, dev_eui):
+        device = self.devices.get(dev_eui)
+        if device is None and not dev_eui.isupper():
+            device = self.devices.get(dev_eui.upper())
+        return device
+
+    def enrichment(self, dev_eui):
+        """(type_id, location_id) of a device, (None, None) when it is not registered."""
+        device = self.get(dev_eui)
+        if device is None:
+            return None, None
+        return device.type_id, device.location_id
+
+    def is_unknown(self, dev_eui):
+        return self.loaded and self.get(dev_eui) is None
+
+    def _query(self, since=None):
+        connection = psycopg2.connect(self.dsn, connect_timeout=self.timeout,
+                                      options=f"-c statement_timeout={self.timeout * 1000}")
+        try:
+            with connection.cursor() as cursor:
+                if since is None:
+                    cursor.execute(DEVICES_QUERY)
+                else:
+                    cursor.execute(DEVICES_QUERY + CHANGED_FILTER, (since,))
+                return cursor.fetchall()
+        finally:
+            connection.close()
+
+    def _apply(self, records, devices):
+        newest = self.newest
+        for dev_eui, device_id, type_id, location_id, updated in records:
+            if not dev_eui:
+                continue
+            devices[dev_eui.upper()] = Device(device_id, type_id, location_id)
+            if updated is not None and (newest is None or updated > newest):
+                newest = updated
+        self.newest = newest
+
+    def load(self):
+        """Full reload; the new dict replaces the old one in one assignment."""
+        devices = {}
+        self.newest = None
+        self._apply(self._query(), devices)
+        self.devices = devices
+        self.loaded = True
+        self.last_full = time.monotonic()
+        self.loads += 1
+        print(f"{datetime.now()} device registry loaded, {len(devices)} devices")
+
+    def update(self):
+        if not self.loaded or time.monotonic() - self.last_full >= self.full_refresh:
+            self.load()
+            return
+        records = self._query(self.newest) if self.newest is not None else []
+        self._apply(records, self.devices)
+        self.refreshes += 1
+        self.changed += len(records)
+
+    def start(self, refresh=True):
+        """Loads the registry, and keeps refreshing it from a background thread unless refresh is False."""
+        try:
+            self.load()
+        except psycopg2.Error as e:
+            self.failures += 1
+            print(f"{datetime.now()} device registry not loaded, accepting all devices: {e}")
+        if refresh:
+            self.thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.refresh)
+            try:
+                self.update()
+            except psycopg2.Error as e:
+                self.failures += 1
+                print(f"{datetime.now()} device registry refresh failed: {e}")
+
+
+class UnknownDiverter:
+    """Sends the uplinks of unregistered devices to their own Kafka topic.
+
+    An uplink that still does not fit in the producer queue after a short
+    poll is dropped and counted in dropped.
+    """
+
+    def __init__(self, producer, topic):
+        self.producer = producer
+        self.topic = topic
+        self.diverted = 0
+        self.dropped = 0
+
+    def __call__(self, document):
+        try:
+            self.producer.produce(self.topic, fast_dumps(document))
+            self.diverted += 1
+        except BufferError:
+            # local queue full: give it a moment to deliver, then drop
+            self.producer.poll(0.1)
+            self.dropped += 1
+        self.producer.poll(0)
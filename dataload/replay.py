@@ -0,0 +1,251 @@
+import argparse
+import configparser
+import importlib
+import multiprocessing
+import os
+import signal
+import time
+from datetime import datetime, timezone
+
+from confluent_kafka import Consumer, TopicPartition
+
+# Re-reads a time range of the uplink topic and writes it to Cassandra again,
+# for data lost downstream or after a payload_dict / measurements.ini change.
+#
+# The range is resolved to offsets per partition with offsets_for_times, each
+# partition's range is cut into --splits pieces and the pieces are shared out
+# over --workers processes. Workers assign() their pieces under a throwaway
+# group, so the live loaders' committed offsets are never touched. Writes are
+# idempotent inserts, so running a range twice is harmless.
+#
+#   python replay.py --loader ac_data_load --from 2024-10-01 --to 2024-11-01 \
+#       --workers 16 --splits 4 --concurrency 256 --skip-latest
+
+CHECK_INTERVAL_SECONDS = 10
+REPORT_INTERVAL_SECONDS = 60
+FINAL_FLUSH_ATTEMPTS = 5
+
+config = configparser.ConfigParser()
+config.read('config.ini')
+
+running = True
+
+
+def parse_time(text):
+    """ISO date or datetime, UTC unless it carries an offset, in epoch milliseconds."""
+    ts = datetime.fromisoformat(text)
+    if ts.tzinfo is None:
+        ts = ts.replace(tzinfo=timezone.utc)
+    return int(ts.timestamp() * 1000)
+
+
+def resolve_ranges(broker, topic, start_ms, end_ms):
+    """[(partition, first offset, end offset)] of the messages in [start_ms, end_ms)."""
+    consumer = Consumer({'bootstrap.servers': broker, 'group.id': 'ptdata_replay_resolve'})
+    try:
+        metadata = consumer.list_topics(topic, timeout=10)
+        if topic not in metadata.topics or metadata.topics[topic].error is not None:
+            raise RuntimeError(f"topic {topic} not found on {broker}")
+        partitions = sorted(metadata.topics[topic].partitions.keys())
+        high = {p: consumer.get_watermark_offsets(TopicPartition(topic, p), timeout=10)[1] for p in partitions}
+
+        def lookup(ms):
+            # offset -1: no message at or after ms, the range runs to the end
+            found = consumer.offsets_for_times([TopicPartition(topic, p, ms) for p in partitions], timeout=10)
+            return {tp.partition: tp.offset if tp.offset >= 0 else high[tp.partition] for tp in found}
+
+        starts = lookup(start_ms)
+        ends = lookup(end_ms) if end_ms is not None else high
+    finally:
+        consumer.close()
+    return [(p, starts[p], ends[p]) for p in partitions if ends[p] > starts[p]]
+
+
+def split_ranges(ranges, splits):
+    pieces = []
+    for partition, start, end in ranges:
+        step = max(1, -(-(end - start) // splits))
+        for first in range(start, end, step):
+            pieces.append((partition, first, min(end, first + step)))
+    return pieces
+
+
+def replay_worker(loader_name, worker_id, topic, group_id, pieces, progress, counters,
+                  concurrency, max_rows, skip_latest):
+    # The loader connects to Cassandra on import, so import it in the child.
+    loader = importlib.import_module(loader_name).loader
+    writer = loader.writer
+    pipeline = loader.pipeline
+    pipeline.rollup = None  # rolled-up hours would count the replayed rows twice
+    decoder = loader.decoder
+    if loader.unknown_devices == 'divert':
+        # the live loader diverted them already; a backfill drops them rather than diverting them again
+        decoder.drop_unknown = True
+    if decoder.registry is not None:
+        if decoder.drop_unknown:
+            # one load is enough for a backfill, no refresh thread
+            decoder.registry.start(refresh=False)
+        else:
+            decoder.registry = None  # unknown devices are kept, nothing to look up
+    writer.concurrency = concurrency
+    writer.max_rows = writer.flush_rows = max_rows
+    writer.write_latest = not skip_latest
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+    consumer = Consumer(dict(loader.conf, **{'group.id': group_id}))
+    try:
+        for index, (partition, start, end) in pieces:
+            first = progress[index]
+            if first >= end:
+                continue
+            print(f"{datetime.now()} replay worker {worker_id}: {topic} [{partition}] {first}..{end}")
+            consumer.assign([TopicPartition(topic, partition, first)])
+            done = first
+            while done < end:
+                if writer.due() and pipeline.flush(consumer):
+                    progress[index] = done
+                msgs = consumer.consume(num_messages=loader.consume_batch_size, timeout=loader.consume_batch_timeout)
+                if not msgs:
+                    # compaction or transaction markers can leave gaps up to the end offset
+                    if consumer.position([TopicPartition(topic, partition)])[0].offset >= end:
+                        done = end
+                    continue
+                wanted = [msg for msg in msgs if msg.error() or msg.offset() < end]
+                pipeline.process(wanted)
+                for msg in msgs:
+                    if not msg.error():
+                        done = min(end, msg.offset() + 1)
+                counters[0] = loader.decoder.messages
+                counters[1] = writer.rows_written
+
+            # recovered quarantine documents belong to this piece as well
+            while loader.quarantine.pending():
+                time.sleep(0.1)
+            pipeline.process([])
+            for attempt in range(FINAL_FLUSH_ATTEMPTS):
+                if pipeline.flush(consumer, asynchronous=False):
+                    break
+                time.sleep(writer.max_interval)
+            else:
+                raise RuntimeError(f"could not write {topic} [{partition}] up to {end}")
+            progress[index] = end
+            counters[1] = writer.rows_written
+    finally:
+        consumer.close()
+
+
+class ReplayWorker:
+
+    def __init__(self, worker_id, pieces, progress):
+        self.worker_id = worker_id
+        self.pieces = pieces  # [(index into progress, (partition, start, end))]
+        self.progress = progress
+        self.counters = multiprocessing.Array('q', 2)  # messages, rows
+        self.retired = [0, 0]
+        self.restarts = 0
+        self.process = None
+
+    def start(self, args, group_id):
+        self.process = multiprocessing.Process(
+            target=replay_worker,
+            args=(args.loader, self.worker_id, args.topic, group_id, self.pieces, self.progress, self.counters,
+                  args.concurrency, args.max_rows, args.skip_latest),
+            name=f"replay-{self.worker_id}")
+        self.process.start()
+
+    def restart(self, args, group_id):
+        # picks up each piece from the offset of its last successful flush
+        self.retired[0] += self.counters[0]
+        self.retired[1] += self.counters[1]
+        self.counters[0] = 0
+        self.counters[1] = 0
+        self.restarts += 1
+        self.start(args, group_id)
+
+    def totals(self):
+        return self.retired[0] + self.counters[0], self.retired[1] + self.counters[1]
+
+
+def stop(signum, frame):
+    global running
+    running = False
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a time range of the uplink topic into Cassandra")
+    parser.add_argument('--loader', default='ac_data_load', help="loader module, e.g. pt_data_load")
+    parser.add_argument('--topic', default='ptdata_prod')
+    parser.add_argument('--from', dest='start', required=True, help="ISO date/time, UTC unless an offset is given")
+    parser.add_argument('--to', dest='end', help="ISO date/time (exclusive), default the end of the topic")
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--splits', type=int, default=1, help="pieces per partition, for more workers than partitions")
+    parser.add_argument('--concurrency', type=int, default=256, help="Cassandra requests in flight per worker")
+    parser.add_argument('--max-rows', type=int, default=20000, help="rows per flush")
+    parser.add_argument('--skip-latest', action='store_true', help="do not write latest_data")
+    parser.add_argument('--max-restarts', type=int, default=3)
+    parser.add_argument('--group', help="consumer group, default a new ptdata_replay_<time> group")
+    args = parser.parse_args()
+
+    broker = config.get('kafka', 'broker')
+    group_id = args.group or f"ptdata_replay_{datetime.now():%Y%m%d%H%M%S}"
+    ranges = resolve_ranges(broker, args.topic, parse_time(args.start),
+                            parse_time(args.end) if args.end else None)
+    if not ranges:
+        print(f"{datetime.now()} no messages in {args.topic} between {args.start} and {args.end or 'now'}")
+        return
+    pieces = split_ranges(ranges, max(1, args.splits))
+    total = sum(end - start for partition, start, end in pieces)
+    progress = multiprocessing.Array('q', [start for partition, start, end in pieces])
+
+    count = max(1, min(args.workers, len(pieces)))
+    indexed = list(enumerate(pieces))
+    workers = [ReplayWorker(i, indexed[i::count], progress) for i in range(count)]
+    print(f"{datetime.now()} replaying {total} messages from {len(ranges)} partitions of {args.topic} "
+          f"in {len(pieces)} pieces with {count} workers, group {group_id}")
+    for worker in workers:
+        worker.start(args, group_id)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    started = last_report = time.monotonic()
+    failed = []
+    while running:
+        time.sleep(CHECK_INTERVAL_SECONDS)
+        active = 0
+        for worker in workers:
+            if worker.process.is_alive():
+                active += 1
+            elif worker.process.exitcode not in (0, None) and worker not in failed:
+                if worker.restarts < args.max_restarts:
+                    print(f"{datetime.now()} replay worker {worker.worker_id} exited with "
+                          f"{worker.process.exitcode}, restarting")
+                    worker.restart(args, group_id)
+                    active += 1
+                else:
+                    failed.append(worker)
+
+        now = time.monotonic()
+        if now - last_report >= REPORT_INTERVAL_SECONDS or not active:
+            done = sum(progress[i] - start for i, (partition, start, end) in enumerate(pieces))
+            messages = sum(w.totals()[0] for w in workers)
+            rows = sum(w.totals()[1] for w in workers)
+            elapsed = now - started
+            print(f"{datetime.now()} {done} of {total} offsets written ({100 * done / total:.1f}%), "
+                  f"{messages} messages, {rows} rows ({messages / elapsed:.0f} msgs/s, {rows / elapsed:.0f} rows/s)")
+            last_report = now
+        if not active:
+            break
+
+    for worker in workers:
+        if worker.process.is_alive():
+            worker.process.terminate()
+    for worker in workers:
+        worker.process.join()
+    for i, (partition, start, end) in enumerate(pieces):
+        if progress[i] < end:
+            print(f"{datetime.now()} incomplete: {args.topic} [{partition}] {progress[i]}..{end}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,252 @@
+import json
+import os
+import uuid
+from datetime import datetime, timedelta
+
+from cassandra.concurrent import execute_concurrent
+from cassandra.query import ConsistencyLevel
+
+HOUR = timedelta(hours=1)
+EMITTED_HOURS = 48  # hours remembered as written, to count late rows
+
+# Partial rollups are written to their own table and hourly_data is
+# recomputed from all partials of a (dev_eui, measurement, hour):
+#
+#   CREATE TABLE hourly_partials (
+#       dev_eui text, measurement text, yearday int, hour int, part uuid,
+#       min double, max double, sum double, count int, type_id int, location_id int,
+#       PRIMARY KEY ((dev_eui, measurement, yearday, hour), part));
+#
+# A part is what one worker rolled up for an hour between two flushes. Its
+# id is fixed, and checkpointed, before the first attempt, so a retried
+# write, or one repeated after a rollback or restart, overwrites instead of
+# adding. hourly_data is written USING TIMESTAMP the newest
+# partial it was computed from, so when two workers recompute an hour at the
+# same time the one that saw more partials wins. aggregator/hourly.py skips
+# the (dev_eui, measurement) hours that have partials.
+
+
+def merge(a, b):
+    """Combines two [min, max, sum, count] accumulators.
+
+    Same rules as aggregator/hourly.py, so both produce the same hourly_data:
+    min is the smallest non-zero value (0 when there is none) and max starts
+    from 0.
+    """
+    if a[0] == 0 or (b[0] != 0 and b[0] < a[0]):
+        low = b[0]
+    else:
+        low = a[0]
+    return [low, max(a[1], b[1]), a[2] + b[2], a[3] + b[3]]
+
+
+class HourlyRollup:
+    """Keeps hourly min/max/sum/count per (dev_eui, measurement) as rows arrive.
+
+    add_many() takes the same rows as the writer. checkpoint() turns every
+    hour that has closed into a part, and flush(), called after the offsets
+    of a successful device_data flush are committed, writes the parts to
+    hourly_partials and then recomputes those hourly_data rows from all
+    their parts. An hour closes once rows more than grace seconds past its
+    end have been seen, so backfills close hours at their own pace. Late
+    rows for an hour that was written before become another part. Parts and
+    hourly_data rows that could not be written stay in memory for the next
+    flush.
+
+    checkpoint() is called just before each commit. It keeps the state as of
+    that commit, and writes it to state_path when one is set (see
+    open_state()), so a restart carries on from the open hours of the
+    committed offsets. rollback() goes back to the last checkpoint when the
+    messages consumed since then are going to be delivered again.
+    With registry set to a registry.DeviceRegistry, parts carry the
+    device's type_id and location_id.
+    """
+
+    def __init__(self, session, grace=300, concurrency=64):
+        self.session = session
+        self.grace = timedelta(seconds=grace)
+        self.concurrency = concurrency
+        self.part_prepared = session.prepare(
+            'INSERT INTO hourly_partials (dev_eui, measurement, yearday, hour, part, "min", "max", "sum", "count", '
+            "type_id, location_id) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)")
+        self.select_prepared = session.prepare(
+            'SELECT "min", "max", "sum", "count", WRITETIME("count") FROM hourly_partials '
+            "WHERE dev_eui = ? AND measurement = ? AND yearday = ? AND hour = ?")
+        self.insert_prepared = session.prepare(
+            "INSERT INTO hourly_data (dev_eui, measurement, min, max, ave, sum, count, yearday, hour) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) USING TIMESTAMP ?")
+        for prepared in (self.part_prepared, self.select_prepared, self.insert_prepared):
+            prepared.consistency_level = ConsistencyLevel.ONE
+
+        self.hours = {}  # hour_start: {(dev_eui, measurement): [min, max, sum, count]}
+        self.parts = []  # (hour_start, part id, {key: accumulator}) not written yet
+        self.unmerged = {}  # hour_start: {keys} whose hourly_data is to be recomputed
+        self.newest = None
+        self.emitted = []
+        self.state_path = None
+        self.snapshot = None
+        self.registry = None
+
+        self.rows = 0
+        self.late_rows = 0
+        self.rollups_written = 0
+        self.rollups_merged = 0
+        self.failed_flushes = 0
+
+    def add_many(self, rows):
+        hours = self.hours
+        bucket_hour = None
+        newest = self.newest
+        for dev_eui, measurement, yearmonth, ts, application_id, value in rows:
+            hour = ts.replace(minute=0, second=0, microsecond=0)
+            if hour != bucket_hour:
+                bucket = hours.get(hour)
+                if bucket is None:
+                    bucket = hours[hour] = {}
+                bucket_hour = hour
+                late = hour in self.emitted
+            if newest is None or ts > newest:
+                newest = ts
+            key = (dev_eui, measurement)
+            acc = bucket.get(key)
+            if acc is None:
+                bucket[key] = [value, max(0, value), value, 1]
+            else:
+                if value != 0 and (acc[0] == 0 or value < acc[0]):
+                    acc[0] = value
+                if value > acc[1]:
+                    acc[1] = value
+                acc[2] += value
+                acc[3] += 1
+            if late:
+                self.late_rows += 1
+        self.newest = newest
+        self.rows += len(rows)
+
+    def pending(self):
+        return sum(len(bucket) for bucket in self.hours.values())
+
+    def closed_hours(self):
+        if self.newest is None:
+            return []
+        return sorted(hour for hour in self.hours if hour + HOUR + self.grace <= self.newest)
+
+    def flush(self):
+        """Writes the parts of the closed hours and recomputes their hourly_data. Returns the number of parts written."""
+        parts, self.parts = self.parts, []
+        written = 0
+        for hour, part, bucket in parts:
+            written += self._write_part(hour, part, bucket)
+        for hour in list(self.unmerged):
+            self._merge_hour(hour, self.unmerged.pop(hour))
+        self.rollups_written += written
+        return written
+
+    def _write_part(self, hour, part, bucket):
+        yearday = (hour.year % 100) * 1000 + hour.timetuple().tm_yday
+        keys = list(bucket)
+        enrichment = self.registry.enrichment if self.registry is not None else lambda dev_eui: (None, None)
+        inserts = [(self.part_prepared, (key[0], key[1], yearday, hour.hour, part, *bucket[key], *enrichment(key[0])))
+                   for key in keys]
+        results = execute_concurrent(self.session, inserts, concurrency=self.concurrency, raise_on_first_error=False)
+        failed = {}
+        written = self.unmerged.setdefault(hour, set())
+        for key, (success, result) in zip(keys, results):
+            if success:
+                written.add(key)
+            else:
+                failed[key] = bucket[key]
+        if failed:
+            # same part id, so the rows that did get written are only overwritten
+            self.failed_flushes += 1
+            self.parts.append((hour, part, failed))
+            print(f"{datetime.now()} {len(failed)} of {len(keys)} hourly rollups for {hour} failed, kept for next flush")
+        if hour not in self.emitted:
+            self.emitted.append(hour)
+            del self.emitted[:-EMITTED_HOURS]
+        return len(keys) - len(failed)
+
+    def _merge_hour(self, hour, keys):
+        yearday = (hour.year % 100) * 1000 + hour.timetuple().tm_yday
+        keys = list(keys)
+        selects = [(self.select_prepared, (dev_eui, measurement, yearday, hour.hour)) for dev_eui, measurement in keys]
+        results = execute_concurrent(self.session, selects, concurrency=self.concurrency, raise_on_first_error=False)
+
+        inserts = []
+        merged_keys = []
+        failed = set()
+        for key, (success, result) in zip(keys, results):
+            if not success:
+                failed.add(key)
+                continue
+            acc = None
+            newest = 0
+            for low, high, total, count, written in result or ():
+                part = [low or 0, high or 0, total or 0, count or 0]
+                acc = part if acc is None else merge(acc, part)
+                newest = max(newest, written or 0)
+            if acc is None or not acc[3]:
+                continue
+            low, high, total, count = acc
+            inserts.append((self.insert_prepared,
+                            (key[0], key[1], low, high, total / count, total, count, yearday, hour.hour, newest)))
+            merged_keys.append(key)
+
+        results = execute_concurrent(self.session, inserts, concurrency=self.concurrency, raise_on_first_error=False)
+        for key, (success, result) in zip(merged_keys, results):
+            if success:
+                self.rollups_merged += 1
+            else:
+                failed.add(key)
+        if failed:
+            self.unmerged.setdefault(hour, set()).update(failed)
+            print(f"{datetime.now()} {len(failed)} of {len(keys)} hourly_data rows for {hour} failed, kept for next flush")
+
+    def open_state(self, path):
+        """Checkpoints go to path from now on; picks up the state an earlier process left there."""
+        self.state_path = path
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                self.snapshot = f.read()
+            self.rollback()
+            print(f"{datetime.now()} hourly rollup state restored, {self.pending()} open rollups")
+
+    def checkpoint(self):
+        """Keeps the current state as the one of the next commit. Raises OSError.
+
+        Closed hours become parts first, so their ids are in the snapshot
+        and writing them again after a rollback or restart overwrites them.
+        """
+        for hour in self.closed_hours():
+            self.parts.append((hour, uuid.uuid4(), self.hours.pop(hour)))
+        snapshot = json.dumps({
+            "hours": [[hour.isoformat(), [[*key, *acc] for key, acc in bucket.items()]]
+                      for hour, bucket in self.hours.items()],
+            "parts": [[hour.isoformat(), str(part), [[*key, *acc] for key, acc in bucket.items()]]
+                      for hour, part, bucket in self.parts],
+            "unmerged": [[hour.isoformat(), [list(key) for key in keys]] for hour, keys in self.unmerged.items()],
+            "newest": self.newest.isoformat() if self.newest is not None else None,
+            "emitted": [hour.isoformat() for hour in self.emitted],
+        }).encode("utf-8")
+        if self.state_path is not None:
+            temporary = self.state_path + ".tmp"
+            with open(temporary, "wb") as f:
+                f.write(snapshot)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temporary, self.state_path)
+        self.snapshot = snapshot
+
+    def rollback(self):
+        """Goes back to the last checkpoint, or to nothing at all without one."""
+        if self.snapshot is None:
+            self.hours, self.parts, self.unmerged, self.newest = {}, [], {}, None
+            return
+        state = json.loads(self.snapshot)
+        parse = datetime.fromisoformat
+        self.hours = {parse(hour): {(r[0], r[1]): r[2:] for r in bucket} for hour, bucket in state["hours"]}
+        self.parts = [(parse(hour), uuid.UUID(part), {(r[0], r[1]): r[2:] for r in bucket})
+                      for hour, part, bucket in state["parts"]]
+        self.unmerged = {parse(hour): {tuple(key) for key in keys} for hour, keys in state["unmerged"]}
+        self.newest = parse(state["newest"]) if state["newest"] else None
+        self.emitted = [parse(hour) for hour in state["emitted"]]
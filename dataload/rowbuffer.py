@@ -0,0 +1,178 @@
+import struct
+from array import array
+from datetime import datetime, timedelta
+
+_EPOCH = datetime(1970, 1, 1)
+_MILLISECOND = timedelta(milliseconds=1)
+_ENCODED_HEADER = struct.Struct("<II")  # rows, bytes of the "\0"-separated strings
+
+
+class StringTable:
+    """Interned dev_eui, measurement and application_id strings.
+
+    Each distinct string is kept once and buffered rows refer to it by
+    index. The table is shared by the writer's successive buffers, so ids
+    stay valid across a flush; CassandraWriter starts a new one when it
+    has grown past MAX_STRINGS and nothing is buffered.
+    """
+
+    MAX_STRINGS = 1000000
+
+    def __init__(self):
+        self.ids = {}
+        self.strings = []
+
+    def __len__(self):
+        return len(self.strings)
+
+    def add(self, string):
+        number = self.ids[string] = len(self.strings)
+        self.strings.append(string)
+        return number
+
+
+class RowBuffer:
+    """Pending device_data rows stored column by column.
+
+    Rows come in as the decoder's (dev_eui, measurement, yearmonth, ts,
+    source_application_id, value) tuples and are kept as one array per
+    column: string ids into a StringTable, yearmonth as u16, ts as int64
+    epoch milliseconds (what Cassandra stores) and value as a double. That
+    is 30 bytes per row instead of a tuple, a datetime, a float and a list
+    slot; bind tuples are only built by row() when the writer sends them,
+    with ts as the epoch milliseconds the driver accepts for a timestamp.
+
+    latest maps (dev_eui id, measurement id) to the index of the newest row
+    for latest_data. Rows below start are latest_data rows carried over
+    from a failed flush only; device_data rows are range(start, len).
+    """
+
+    def __init__(self, strings):
+        self.strings = strings
+        self.dev_euis = array("I")
+        self.measurements = array("I")
+        self.yearmonths = array("H")
+        self.timestamps = array("q")
+        self.applications = array("I")
+        self.values = array("d")
+        self.latest = {}
+        self.start = 0
+
+    def __len__(self):
+        return len(self.values) - self.start
+
+    def add_many(self, rows, track_latest=True):
+        ids = self.strings.ids
+        add_string = self.strings.add
+        dev_euis, measurements = self.dev_euis, self.measurements
+        timestamps, values = self.timestamps, self.values
+        yearmonths, applications = self.yearmonths, self.applications
+        latest = self.latest
+        index = len(values)
+        last_ts = last_ms = None
+        for dev_eui, measurement, yearmonth, ts, application_id, value in rows:
+            dev_id = ids.get(dev_eui)
+            if dev_id is None:
+                dev_id = add_string(dev_eui)
+            measurement_id = ids.get(measurement)
+            if measurement_id is None:
+                measurement_id = add_string(measurement)
+            application = ids.get(application_id)
+            if application is None:
+                application = add_string(application_id)
+            # the rows of one uplink share their datetime
+            if ts is not last_ts:
+                last_ts, last_ms = ts, (ts - _EPOCH) // _MILLISECOND
+            dev_euis.append(dev_id)
+            measurements.append(measurement_id)
+            yearmonths.append(yearmonth)
+            timestamps.append(last_ms)
+            applications.append(application)
+            values.append(value)
+            if track_latest:
+                key = (dev_id, measurement_id)
+                current = latest.get(key)
+                if current is None or last_ms >= timestamps[current]:
+                    latest[key] = index
+            index += 1
+
+    def copy(self, other, indices):
+        """Appends rows of another buffer sharing the same StringTable; returns their new indices."""
+        first = len(self.values)
+        for i in indices:
+            self.dev_euis.append(other.dev_euis[i])
+            self.measurements.append(other.measurements[i])
+            self.yearmonths.append(other.yearmonths[i])
+            self.timestamps.append(other.timestamps[i])
+            self.applications.append(other.applications[i])
+            self.values.append(other.values[i])
+        return range(first, len(self.values))
+
+    def key(self, index):
+        """The partition key ids (dev_eui, measurement, yearmonth) of a row."""
+        return self.dev_euis[index], self.measurements[index], self.yearmonths[index]
+
+    def row(self, index):
+        strings = self.strings.strings
+        return (strings[self.dev_euis[index]], strings[self.measurements[index]], self.yearmonths[index],
+                self.timestamps[index], strings[self.applications[index]], self.values[index])
+
+    def latest_row(self, index):
+        strings = self.strings.strings
+        return (strings[self.dev_euis[index]], strings[self.measurements[index]],
+                self.timestamps[index], strings[self.applications[index]], self.values[index])
+
+    def rows(self):
+        """device_data bind tuples, built one at a time."""
+        row = self.row
+        return (row(i) for i in range(self.start, len(self.values)))
+
+    def encode(self, first, last):
+        """Rows first..last as bytes: their strings, then each column, without the shared StringTable."""
+        strings = self.strings.strings
+        local = {}
+        names = []
+        encoded = []
+        for column in (self.dev_euis, self.measurements, self.applications):
+            ids = array("I")
+            for string_id in column[first:last]:
+                number = local.get(string_id)
+                if number is None:
+                    number = local[string_id] = len(names)
+                    names.append(strings[string_id])
+                ids.append(number)
+            encoded.append(ids.tobytes())
+        text = "\0".join(names).encode()
+        return b"".join([_ENCODED_HEADER.pack(last - first, len(text)), text, *encoded,
+                         self.yearmonths[first:last].tobytes(), self.timestamps[first:last].tobytes(),
+                         self.values[first:last].tobytes()])
+
+    def extend_encoded(self, data):
+        """Appends rows made by encode() as device_data rows. Returns how many."""
+        count, text_length = _ENCODED_HEADER.unpack_from(data)
+        offset = _ENCODED_HEADER.size
+        names = data[offset:offset + text_length].decode().split("\0") if text_length else []
+        offset += text_length
+        ids = self.strings.ids
+        add_string = self.strings.add
+        string_ids = [ids[name] if name in ids else add_string(name) for name in names]
+        columns = []
+        for typecode in ("I", "I", "I", "H", "q", "d"):
+            column = array(typecode)
+            size = column.itemsize * count
+            column.frombytes(data[offset:offset + size])
+            offset += size
+            columns.append(column)
+        dev_euis, measurements, applications, yearmonths, timestamps, values = columns
+        self.dev_euis.extend(string_ids[i] for i in dev_euis)
+        self.measurements.extend(string_ids[i] for i in measurements)
+        self.applications.extend(string_ids[i] for i in applications)
+        self.yearmonths.extend(yearmonths)
+        self.timestamps.extend(timestamps)
+        self.values.extend(values)
+        return count
+
+    def nbytes(self):
+        columns = (self.dev_euis, self.measurements, self.yearmonths, self.timestamps,
+                   self.applications, self.values)
+        return sum(column.itemsize * column.buffer_info()[1] for column in columns)
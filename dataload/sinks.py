@@ -0,0 +1,372 @@
+import hashlib
+import os
+import queue
+import struct
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+
+try:
+    import psycopg2
+    from psycopg2.extras import execute_values
+except ImportError:
+    psycopg2 = None
+
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
+from formats import fast_dumps, write_parquet
+from spool import encode_record, read_record
+
+# Extra destinations for the decoded rows, next to Cassandra. The Pipeline
+# offers every decoded batch to each sink; offer() only puts the batch on
+# the sink's bounded queue, and the sink's own thread takes batches off it
+# and writes them max_rows at a time or every max_interval seconds. When the
+# queue is full the batch is dropped, or with overflow = spill appended to
+# a spill file the thread writes back once it has caught up, so a slow or
+# unreachable sink never holds up the consume loop. Batches whose write
+# failed go the same way.
+#
+# Sinks are best effort: they see rows when they are decoded, before the
+# offsets are committed, so a restart can hand them rows twice.
+
+_OFFSET = struct.Struct("<Q")
+
+
+class SpillFile:
+    """Rows a sink could not keep up with, in the spool's record format.
+
+    append() is called from the consume loop and take() from the sink
+    thread. Once everything has been taken back the file is emptied. Rows
+    left by an earlier process are taken as well, from the read offset it
+    kept in <path>.offset.
+    """
+
+    def __init__(self, path, max_bytes=256 * 1024 * 1024):
+        self.path = path
+        self.offset_path = path + ".offset"
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.size = os.path.getsize(path) if os.path.exists(path) else 0
+        self.read_offset = 0
+        if os.path.exists(self.offset_path):
+            with open(self.offset_path, "rb") as f:
+                data = f.read(_OFFSET.size)
+            if len(data) == _OFFSET.size:
+                self.read_offset = min(_OFFSET.unpack(data)[0], self.size)
+
+    def pending(self):
+        return self.size > self.read_offset
+
+    def append(self, rows):
+        """Returns False, keeping nothing, when the file is full."""
+        record = encode_record(rows)
+        with self.lock:
+            if self.size + len(record) > self.max_bytes:
+                return False
+            with open(self.path, "ab") as f:
+                f.write(record)
+            self.size += len(record)
+        return True
+
+    def take(self, max_rows):
+        rows = []
+        with self.lock:
+            if self.read_offset >= self.size:
+                return rows
+            with open(self.path, "rb") as f:
+                f.seek(self.read_offset)
+                while len(rows) < max_rows:
+                    record, size = read_record(f)
+                    if record is None:
+                        break
+                    rows.extend(record)
+                    self.read_offset += size
+            if self.read_offset >= self.size or len(rows) < max_rows:
+                # read to the end, or to a record cut short by a crash
+                open(self.path, "wb").close()
+                self.size = self.read_offset = 0
+            self._save_offset()
+        return rows
+
+    def _save_offset(self):
+        if not self.read_offset:
+            if os.path.exists(self.offset_path):
+                os.remove(self.offset_path)
+            return
+        with open(self.offset_path + ".tmp", "wb") as f:
+            f.write(_OFFSET.pack(self.read_offset))
+        os.replace(self.offset_path + ".tmp", self.offset_path)
+
+
+def lock_key(dev_eui, measurement, yearmonth):
+    """A signed 64-bit PostgreSQL advisory lock key for one device_summ row."""
+    digest = hashlib.blake2b(f"{dev_eui}\0{measurement}\0{yearmonth}".encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "big", signed=True)
+
+
+class Sink:
+    """One destination for decoded rows, written from its own thread.
+
+    Subclasses set name and implement write(rows), which raises when the
+    rows did not get there; close_connection() is called after a failure.
+    Observers are called from the sink thread as
+    observer("sink_write:<name>", seconds, rows) for each write and
+    observer("sink_delay:<name>", seconds, rows) with how long the oldest
+    row of the write waited in the queue.
+    With registry set to a registry.DeviceRegistry, sinks that write
+    per-row records add the device's type_id and location_id.
+    """
+
+    name = "sink"
+
+    def __init__(self, max_rows=5000, max_interval=5.0, queue_batches=1000, spill=None):
+        self.max_rows = max_rows
+        self.max_interval = max_interval
+        self.queue = queue.Queue(queue_batches)
+        self.spill = spill
+        self.registry = None
+        self.observers = []
+        self.thread = threading.Thread(target=self._run, name=f"sink-{self.name}", daemon=True)
+
+        self.offered = 0
+        self.rows_written = 0
+        self.dropped = 0
+        self.spilled = 0
+        self.writes = 0
+        self.failed_writes = 0
+        self.last_error = None
+
+    def add_observer(self, observe):
+        self.observers.append(observe)
+
+    def start(self):
+        self.thread.start()
+
+    def depth(self):
+        return self.queue.qsize()
+
+    def offer(self, rows):
+        if not rows:
+            return
+        self.offered += len(rows)
+        try:
+            self.queue.put_nowait((time.monotonic(), rows))
+        except queue.Full:
+            self._overflow(rows)
+
+    def close(self, timeout=10):
+        """Writes what is queued, within timeout seconds, and stops the thread."""
+        if not self.thread.is_alive():
+            return
+        try:
+            self.queue.put(None, timeout=timeout)
+        except queue.Full:
+            return
+        self.thread.join(timeout)
+
+    def _overflow(self, rows):
+        if self.spill is not None and self.spill.append(rows):
+            self.spilled += len(rows)
+        else:
+            self.dropped += len(rows)
+
+    def _collect(self):
+        """Rows queued until max_rows or max_interval, their oldest queue time, and whether to stop."""
+        rows = []
+        oldest = None
+        deadline = time.monotonic() + self.max_interval
+        while len(rows) < self.max_rows:
+            timeout = deadline - time.monotonic()
+            try:
+                item = self.queue.get(timeout=timeout) if timeout > 0 else self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                return rows, oldest, True
+            queued, batch = item
+            if oldest is None:
+                oldest = queued
+            rows.extend(batch)
+        return rows, oldest, False
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            rows, oldest, stopping = self._collect()
+            if rows:
+                self._write(rows, oldest)
+            if self.spill is not None and self.spill.pending() and self.queue.empty():
+                # caught up with live rows, so catch up with the spilled ones
+                spilled = self.spill.take(self.max_rows)
+                if spilled:
+                    self._write(spilled, None)
+
+    def _write(self, rows, oldest):
+        start = time.monotonic()
+        try:
+            self.write(rows)
+        except Exception as e:
+            self.failed_writes += 1
+            self.last_error = f"{datetime.now()} {e}"
+            print(f"{datetime.now()} {self.name} sink failed to write {len(rows)} rows: {e}")
+            self.close_connection()
+            self._overflow(rows)
+            return
+        now = time.monotonic()
+        self.writes += 1
+        self.rows_written += len(rows)
+        for observe in self.observers:
+            observe(f"sink_write:{self.name}", now - start, len(rows))
+            if oldest is not None:
+                observe(f"sink_delay:{self.name}", now - oldest, len(rows))
+
+    def enrichment(self):
+        """A dev_eui -> (type_id, location_id) lookup for one write."""
+        if self.registry is None:
+            return lambda dev_eui: (None, None)
+        return self.registry.enrichment
+
+    def write(self, rows):
+        raise NotImplementedError
+
+    def close_connection(self):
+        pass
+
+
+class DeviceSummSink(Sink):
+    """Adds the rows per (dev_eui, measurement, yearmonth) to the packetthings device_summ counts.
+
+    device_summ has no unique key to upsert on, so every write updates the
+    rows that exist and inserts the missing ones in one transaction. Every
+    worker runs this sink, so the transaction first takes a transaction
+    advisory lock per (dev_eui, measurement, yearmonth), in lock key order
+    so two writes cannot deadlock; a worker inserting a new row then makes
+    the other wait and update it instead of inserting it again.
+    """
+
+    name = "device_summ"
+
+    LOCK = "SELECT pg_advisory_xact_lock(v.key) FROM (VALUES %s) AS v (key)"
+    UPDATE = """
+        UPDATE device_summ AS s SET count = s.count + v.count
+        FROM (VALUES %s) AS v (dev_eui, measurement, yearmonth, count)
+        WHERE s.dev_eui = v.dev_eui AND s.measurement = v.measurement AND s.yearmonth = v.yearmonth
+    """
+    INSERT = """
+        INSERT INTO device_summ (dev_eui, measurement, yearmonth, count)
+        SELECT v.dev_eui, v.measurement, v.yearmonth, v.count
+        FROM (VALUES %s) AS v (dev_eui, measurement, yearmonth, count)
+        WHERE NOT EXISTS (SELECT 1 FROM device_summ s WHERE s.dev_eui = v.dev_eui
+                          AND s.measurement = v.measurement AND s.yearmonth = v.yearmonth)
+    """
+
+    def __init__(self, dsn, timeout=10, **policy):
+        if psycopg2 is None:
+            raise RuntimeError("the device_summ sink needs psycopg2")
+        super().__init__(**policy)
+        self.dsn = dsn
+        self.timeout = timeout
+        self.connection = None
+
+    def write(self, rows):
+        counts = Counter((row[0], row[1], row[2]) for row in rows)
+        values = [(dev_eui, measurement, yearmonth, count)
+                  for (dev_eui, measurement, yearmonth), count in counts.items()]
+        if self.connection is None:
+            self.connection = psycopg2.connect(self.dsn, connect_timeout=self.timeout,
+                                               options=f"-c statement_timeout={self.timeout * 1000}")
+        locks = sorted({lock_key(dev_eui, measurement, yearmonth) for dev_eui, measurement, yearmonth, count in values})
+        with self.connection, self.connection.cursor() as cursor:
+            execute_values(cursor, self.LOCK, [(key,) for key in locks], page_size=1000)
+            execute_values(cursor, self.UPDATE, values, page_size=1000)
+            execute_values(cursor, self.INSERT, values, page_size=1000)
+
+    def close_connection(self):
+        if self.connection is not None:
+            try:
+                self.connection.close()
+            except psycopg2.Error:
+                pass
+            self.connection = None
+
+
+class ParquetSink(Sink):
+    """Decoded rows as Parquet files under <root>/yyyymmdd=<day>/, one file per write and day.
+
+    type_id and location_id are null without a registry or for unregistered devices.
+    """
+
+    name = "parquet"
+
+    def __init__(self, root, worker=0, compression="zstd", **policy):
+        if pa is None:
+            raise RuntimeError("the parquet sink needs pyarrow")
+        super().__init__(**policy)
+        self.root = root
+        self.worker = worker
+        self.compression = compression
+        self.schema = pa.schema([
+            ("dev_eui", pa.string()),
+            ("measurement", pa.string()),
+            ("yearmonth", pa.int32()),
+            ("ts", pa.timestamp("us")),
+            ("source_application_id", pa.string()),
+            ("value", pa.float64()),
+            ("type_id", pa.int64()),
+            ("location_id", pa.int64()),
+        ])
+        self.sequence = 0
+        self.files = 0
+
+    def write(self, rows):
+        days = {}
+        for row in rows:
+            ts = row[3]
+            days.setdefault(ts.year * 10000 + ts.month * 100 + ts.day, []).append(row)
+        enrichment = self.enrichment()
+        for day, day_rows in days.items():
+            directory = os.path.join(self.root, f"yyyymmdd={day}")
+            os.makedirs(directory, exist_ok=True)
+            self.sequence += 1
+            path = os.path.join(directory, f"part-{self.worker}-{int(time.time() * 1000)}-{self.sequence}.parquet")
+            columns = [list(column) for column in zip(*day_rows)]
+            columns.extend(list(column) for column in zip(*(enrichment(row[0]) for row in day_rows)))
+            table = pa.table(columns, schema=self.schema)
+            write_parquet(path, table, self.compression)
+            self.files += 1
+
+
+class PubSubSink(Sink):
+    """Publishes every row as JSON to a Kafka topic, keyed by dev_eui, for live dashboards."""
+
+    name = "pubsub"
+
+    def __init__(self, producer, topic, **policy):
+        super().__init__(**policy)
+        self.producer = producer
+        self.topic = topic
+
+    def write(self, rows):
+        produce = self.producer.produce
+        enrichment = self.enrichment()
+        for dev_eui, measurement, yearmonth, ts, application_id, value in rows:
+            type_id, location_id = enrichment(dev_eui)
+            message = fast_dumps({"dev_eui": dev_eui, "measurement": measurement, "ts": ts.isoformat(),
+                                  "source_application_id": application_id, "value": value,
+                                  "type_id": type_id, "location_id": location_id})
+            try:
+                produce(self.topic, message, key=dev_eui)
+            except BufferError:
+                # local queue full: let it deliver, then try once more
+                self.producer.poll(0.5)
+                produce(self.topic, message, key=dev_eui)
+        self.producer.poll(0)
+
+    def close(self, timeout=10):
+        super().close(timeout)
+        self.producer.flush(timeout)
@@ -0,0 +1,83 @@
+from timestamps import TimestampParser
+
+# Source decoders: what the UplinkDecoder needs from one parsed Kafka value,
+# per message format. The engine picks one per topic from the [sources]
+# section of config.ini, e.g.
+#
+#   [sources]
+#   ptdata_prod = tts
+#   minsait5gcam = minsait5gcam
+#
+# uplink(document) returns (dev_eui, application_id, f_cnt, received_at,
+# decoded), decoded being the {key: value} dict mapped to measurements, or
+# None when the document carries no rows. Missing fields raise KeyError,
+# TypeError and the like, which the decoder counts as skipped.
+
+
+class TtsSource:
+    """TTS v3 uplinks: payload.end_device_ids and payload.uplink_message."""
+
+    name = "tts"
+    registered = True  # dev_euis are checked against the device registry
+    archived = True  # documents go to the uplink archive
+
+    def __init__(self, parse_ts=None):
+        self.parse_ts = parse_ts or TimestampParser().parse
+
+    def uplink(self, data):
+        payload = data["payload"]
+        ids = payload["end_device_ids"]
+        uplink = payload["uplink_message"]
+        return (ids["dev_eui"], ids["application_ids"]["application_id"], uplink.get("f_cnt"),
+                uplink["received_at"], uplink["decoded_payload"])
+
+
+class ActilitySource(TtsSource):
+    """Actility uplinks, forwarded in the TTS layout with a "+0000" received_at.
+
+    Timestamps are kept to the second, like the Actility loader always did.
+    """
+
+    name = "actility"
+
+    def __init__(self, parse_ts=None):
+        super().__init__(parse_ts or TimestampParser(fraction=False).parse)
+
+
+class PeopleCounterSource:
+    """minsait5gcam AI camera events, as aicam/main.py reads them.
+
+    Only the makati_people_counter events of counting line 1 carry rows;
+    device is the camera and the application is the event key, so the
+    In/Out/Capacity/Sum counts map through [app:makati_people_counter] in
+    measurements.ini.
+    """
+
+    name = "minsait5gcam"
+    registered = False
+    archived = False
+    COUNTS = ("In", "Out", "Capacity", "Sum")
+
+    def __init__(self, parse_ts=None, key="makati_people_counter", line=1):
+        self.parse_ts = parse_ts or TimestampParser(fraction=False).parse
+        self.key = key
+        self.line = line
+
+    def uplink(self, data):
+        if data.get("key") != self.key:
+            return None
+        payload = data["payload"]
+        if int(payload["line"]) != self.line:
+            return None
+        decoded = {count: int(payload[count]) for count in self.COUNTS}
+        return payload["device"], self.key, None, payload["time"], decoded
+
+
+SOURCES = {source.name: source for source in (TtsSource, ActilitySource, PeopleCounterSource)}
+
+
+def source_for(name):
+    try:
+        return SOURCES[name]()
+    except KeyError:
+        raise ValueError(f"unknown source {name!r}, expected one of {', '.join(SOURCES)}") from None
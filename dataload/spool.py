@@ -0,0 +1,197 @@
+import mmap
+import os
+import struct
+from datetime import datetime, timedelta
+
+# Write-ahead spool for rows that are buffered but not yet in Cassandra.
+#
+# Rows are appended in binary form to pre-allocated, memory-mapped segment
+# files, so a decoded batch costs a memcpy instead of an open/write/close.
+# Once a flush succeeds the spool is rotated: older segments are deleted and
+# the current one is rewound. On startup replay() returns whatever an earlier
+# process left behind so it can be written first.
+#
+# Record: u32 payload length, u32 row count, then per row
+#   u16 dev_eui len, u16 measurement len, u16 application_id len,
+#   i32 yearmonth, i64 ts (epoch microseconds), f64 value, the three strings.
+# A zero length ends the segment. The length is written last, so a record
+# cut short by a crash is never replayed.
+
+SEGMENT_SIZE = 64 * 1024 * 1024
+
+_HEADER = struct.Struct("<II")
+_ROW = struct.Struct("<HHHiqd")
+_END = b"\0" * _HEADER.size
+_EPOCH = datetime(1970, 1, 1)
+_MICROSECOND = timedelta(microseconds=1)
+
+
+def encode_rows(rows):
+    parts = []
+    pack = _ROW.pack
+    for dev_eui, measurement, yearmonth, ts, application_id, value in rows:
+        dev_eui_b = dev_eui.encode()
+        measurement_b = measurement.encode()
+        application_b = application_id.encode()
+        parts.append(pack(len(dev_eui_b), len(measurement_b), len(application_b),
+                          yearmonth, (ts - _EPOCH) // _MICROSECOND, value))
+        parts.append(dev_eui_b)
+        parts.append(measurement_b)
+        parts.append(application_b)
+    return b"".join(parts)
+
+
+def decode_rows(buffer, offset, count):
+    rows = []
+    unpack = _ROW.unpack_from
+    for _ in range(count):
+        dev_len, measurement_len, application_len, yearmonth, micros, value = unpack(buffer, offset)
+        offset += _ROW.size
+        dev_eui = bytes(buffer[offset:offset + dev_len]).decode()
+        offset += dev_len
+        measurement = bytes(buffer[offset:offset + measurement_len]).decode()
+        offset += measurement_len
+        application_id = bytes(buffer[offset:offset + application_len]).decode()
+        offset += application_len
+        rows.append((dev_eui, measurement, yearmonth, _EPOCH + micros * _MICROSECOND, application_id, value))
+    return rows
+
+
+def encode_record(rows):
+    """One record, header included, for files appended to with plain writes."""
+    payload = encode_rows(rows)
+    return _HEADER.pack(len(payload), len(rows)) + payload
+
+
+def read_record(f):
+    """Reads the next encode_record() record from a file.
+
+    Returns (rows, bytes read), or (None, 0) at the end of the file or at a
+    record cut short.
+    """
+    header = f.read(_HEADER.size)
+    if len(header) < _HEADER.size:
+        return None, 0
+    length, count = _HEADER.unpack(header)
+    payload = f.read(length)
+    if len(payload) < length:
+        return None, 0
+    return decode_rows(payload, 0, count), _HEADER.size + length
+
+
+class Segment:
+
+    def __init__(self, path, size):
+        self.path = path
+        exists = os.path.exists(path)
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        if not exists or os.fstat(self.fd).st_size < size:
+            if hasattr(os, "posix_fallocate"):
+                os.posix_fallocate(self.fd, 0, size)
+            else:
+                os.ftruncate(self.fd, size)
+        self.size = os.fstat(self.fd).st_size
+        self.map = mmap.mmap(self.fd, self.size)
+        self.pos = 0
+
+    def records(self):
+        """Yields (offset, count) of every complete record and leaves pos at the end."""
+        pos = 0
+        while pos + _HEADER.size <= self.size:
+            length, count = _HEADER.unpack_from(self.map, pos)
+            if length == 0 or pos + _HEADER.size + length > self.size:
+                break
+            yield pos + _HEADER.size, count
+            pos += _HEADER.size + length
+        self.pos = pos
+
+    def room(self):
+        return self.size - self.pos - 2 * _HEADER.size
+
+    def append(self, payload, count):
+        start = self.pos + _HEADER.size
+        end = start + len(payload)
+        self.map[start:end] = payload
+        if end + _HEADER.size <= self.size:
+            self.map[end:end + _HEADER.size] = _END
+        _HEADER.pack_into(self.map, self.pos, len(payload), count)
+        self.pos = end
+
+    def rewind(self):
+        self.map[0:_HEADER.size] = _END
+        self.pos = 0
+
+    def close(self):
+        self.map.close()
+        os.close(self.fd)
+
+
+class Spool:
+
+    def __init__(self, directory, segment_size=SEGMENT_SIZE):
+        self.directory = directory
+        self.segment_size = segment_size
+        os.makedirs(directory, exist_ok=True)
+        self.segments = []
+        self.rows = 0
+        self.bytes = 0
+        self.rotations = 0
+
+    def _path(self, number):
+        return os.path.join(self.directory, f"segment-{number:08d}.spool")
+
+    def _numbers(self):
+        numbers = []
+        for name in os.listdir(self.directory):
+            if name.startswith("segment-") and name.endswith(".spool"):
+                numbers.append(int(name[8:-6]))
+        return sorted(numbers)
+
+    def replay(self):
+        """Opens the segments left on disk and returns the rows they hold."""
+        rows = []
+        for number in self._numbers():
+            segment = Segment(self._path(number), self.segment_size)
+            for offset, count in segment.records():
+                rows.extend(decode_rows(segment.map, offset, count))
+            self.segments.append((number, segment))
+        if not self.segments:
+            self.segments.append((1, Segment(self._path(1), self.segment_size)))
+        self.rows = len(rows)
+        return rows
+
+    def append(self, rows):
+        if not rows:
+            return
+        if not self.segments:
+            self.replay()
+        payload = encode_rows(rows)
+        number, segment = self.segments[-1]
+        if segment.room() < len(payload):
+            number += 1
+            segment = Segment(self._path(number), max(self.segment_size, len(payload) + 2 * _HEADER.size))
+            segment.rewind()
+            self.segments.append((number, segment))
+        segment.append(payload, len(rows))
+        self.rows += len(rows)
+        self.bytes += len(payload)
+
+    def rotate(self):
+        """Called after a successful flush: everything spooled so far is in Cassandra."""
+        if not self.segments:
+            return
+        for number, segment in self.segments[:-1]:
+            segment.close()
+            os.remove(segment.path)
+        number, segment = self.segments[-1]
+        segment.rewind()
+        self.segments = [(number, segment)]
+        self.rows = 0
+        self.bytes = 0
+        self.rotations += 1
+
+    def close(self):
+        for number, segment in self.segments:
+            segment.map.flush()
+            segment.close()
+        self.segments = []
@@ -0,0 +1,134 @@
+import argparse
+import configparser
+import importlib
+import multiprocessing
+import os
+import signal
+import time
+from datetime import datetime
+
+from confluent_kafka import Consumer
+
+# Starts one loader process per core, each with an explicit share of the
+# partitions of the loader's topics, restarts the ones that die and prints
+# the combined throughput. The topics are those of [sources] in config.ini,
+# like the loaders consume, or ptdata_prod without the section; --topic
+# overrides them. Workers use assign() under the loader's group id, so do
+# not run subscribe-mode loaders (pt_data_load.py <n>) against the same
+# group.
+#
+#   python supervisor.py --loader ac_data_load --workers 8
+
+CHECK_INTERVAL_SECONDS = 10
+REPORT_INTERVAL_SECONDS = 60
+
+config = configparser.ConfigParser()
+config.read('config.ini')
+
+running = True
+
+
+def discover_partitions(broker, topic):
+    consumer = Consumer({'bootstrap.servers': broker, 'group.id': 'ptdata_supervisor'})
+    try:
+        metadata = consumer.list_topics(topic, timeout=10)
+    finally:
+        consumer.close()
+    if topic not in metadata.topics or metadata.topics[topic].error is not None:
+        raise RuntimeError(f"topic {topic} not found on {broker}")
+    return sorted(metadata.topics[topic].partitions.keys())
+
+
+def configured_topics():
+    if config.has_section('sources'):
+        return [topic for topic, name in config.items('sources') if topic not in config.defaults()]
+    return ['ptdata_prod']
+
+
+def worker_main(loader_name, worker_id, assignment, counters):
+    # The loader connects to Cassandra on import, so import it in the child.
+    loader = importlib.import_module(loader_name).loader
+    loader.run_worker(worker_id, assignment, counters)
+
+
+class Worker:
+
+    def __init__(self, loader_name, worker_id, assignment):
+        self.loader_name = loader_name
+        self.worker_id = worker_id
+        self.assignment = assignment  # [(topic, partition)]
+        self.counters = multiprocessing.Array('q', 2)  # messages, rows
+        self.retired = [0, 0]  # totals of earlier incarnations
+        self.restarts = 0
+        self.process = None
+
+    def start(self):
+        self.process = multiprocessing.Process(
+            target=worker_main,
+            args=(self.loader_name, self.worker_id, self.assignment, self.counters),
+            name=f"{self.loader_name}-{self.worker_id}")
+        self.process.start()
+
+    def restart(self):
+        self.retired[0] += self.counters[0]
+        self.retired[1] += self.counters[1]
+        self.counters[0] = 0
+        self.counters[1] = 0
+        self.restarts += 1
+        self.start()
+
+    def totals(self):
+        return self.retired[0] + self.counters[0], self.retired[1] + self.counters[1]
+
+
+def stop(signum, frame):
+    global running
+    running = False
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run one Kafka loader worker per core")
+    parser.add_argument('--loader', default='ac_data_load', help="loader module, e.g. pt_data_load")
+    parser.add_argument('--topic', action='append', help="topic to consume, repeatable; default the [sources] topics")
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    broker = config.get('kafka', 'broker')
+    topics = args.topic or configured_topics()
+    assignment = [(topic, partition) for topic in topics for partition in discover_partitions(broker, topic)]
+    count = max(1, min(args.workers, len(assignment)))
+    print(f"{datetime.now()} {', '.join(topics)} have {len(assignment)} partitions, starting {count} workers")
+
+    workers = [Worker(args.loader, i, assignment[i::count]) for i in range(count)]
+    for worker in workers:
+        worker.start()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    last_report = time.monotonic()
+    last_messages, last_rows = 0, 0
+    while running:
+        time.sleep(CHECK_INTERVAL_SECONDS)
+        for worker in workers:
+            if running and not worker.process.is_alive():
+                print(f"{datetime.now()} worker {worker.worker_id} exited with {worker.process.exitcode}, restarting")
+                worker.restart()
+
+        now = time.monotonic()
+        if now - last_report >= REPORT_INTERVAL_SECONDS:
+            messages = sum(w.totals()[0] for w in workers)
+            rows = sum(w.totals()[1] for w in workers)
+            elapsed = now - last_report
+            print(f"{datetime.now()} {messages} messages, {rows} rows "
+                  f"({(messages - last_messages) / elapsed:.0f} msgs/s, {(rows - last_rows) / elapsed:.0f} rows/s)")
+            last_report, last_messages, last_rows = now, messages, rows
+
+    for worker in workers:
+        worker.process.terminate()
+    for worker in workers:
+        worker.process.join()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+import json
+import random
+from datetime import datetime, timedelta
+
+# Synthetic uplinks for the offline benchmarks. Devices belong to a few
+# application profiles with their own decoded_payload keys, mapped and
+# unmapped, and arrive as TTS v3 JSON (received_at with nanoseconds and Z)
+# or Actility-style JSON (received_at with +0000, customer fields). A small
+# share is sent as a Python dict repr, like some producers do, to exercise
+# the quarantine path.
+
+PROFILES = {
+    "pt_iaq": lambda r: {
+        "temperature": round(r.uniform(18, 35), 2),
+        "humidity": round(r.uniform(35, 95), 1),
+        "co2": r.randint(400, 2500),
+        "tvoc": r.randint(0, 900),
+        "pm2_5": r.randint(0, 150),
+        "pm10": r.randint(0, 250),
+        "battery": round(r.uniform(3.0, 3.7), 2),
+        "light_level": r.randint(0, 5),
+    },
+    "pt_modbus": lambda r: {
+        "raw_payload": "01 03 10 43 72 05 1f 43 e1 e3 d7 43 a8 87 ae 44 80 af 5c a3 de",
+        "Voltage_L1N": round(r.uniform(220, 240), 2),
+        "Positive_Active_Energy_Total": round(r.uniform(1000, 90000), 3),
+        "Positive_Active_Energy_L10": round(r.uniform(0, 900), 3),
+        "Total_Active_Power": round(r.uniform(0, 50), 3),
+        "Frequency": round(r.uniform(59.9, 60.1), 2),
+        "meter": {"voltage_l2": round(r.uniform(220, 240), 2), "phase": {"current": round(r.uniform(0, 30), 2)}},
+    },
+    "pt_door": lambda r: {
+        "door_state": r.randint(0, 1),
+        "door_trigger_num": r.randint(0, 5000),
+        "battery": r.randint(60, 100),
+        "status": "ok",
+    },
+    "pt_level": lambda r: {
+        "distance": r.randint(100, 4000),
+        "battery": round(r.uniform(3.0, 3.7), 2),
+        "temp": round(r.uniform(20, 40), 1),
+        "alarm": False,
+    },
+}
+
+
+def received_at_tts(ts):
+    return ts.strftime("%Y-%m-%dT%H:%M:%S.%f") + "123Z"
+
+
+def received_at_actility(ts):
+    return ts.strftime("%Y-%m-%dT%H:%M:%S") + "+0000"
+
+
+def uplink(dev_eui, application_id, ts, f_cnt, decoded, actility=False):
+    received_at = received_at_actility(ts) if actility else received_at_tts(ts)
+    payload = {
+        "end_device_ids": {
+            "device_id": f"eui-{dev_eui.lower()}",
+            "application_ids": {"application_id": application_id},
+            "dev_eui": dev_eui,
+            "join_eui": "",
+        },
+        "received_at": received_at,
+        "uplink_message": {
+            "f_cnt": f_cnt,
+            "f_port": 2,
+            "decoded_payload": decoded,
+            "received_at": received_at,
+        },
+    }
+    if actility:
+        payload["actility_customer_id"] = "100001330"
+        payload["actility_customer_data"] = {"loc": None, "alr": {"pro": None, "ver": None}, "tags": [],
+                                             "doms": [], "name": f"md-{dev_eui}"}
+    else:
+        payload["uplink_message"]["rx_metadata"] = [
+            {"gateway_ids": {"gateway_id": "pwx-gw-01"}, "rssi": -97, "snr": 7.5, "channel_index": 2}]
+        payload["uplink_message"]["settings"] = {
+            "data_rate": {"lora": {"bandwidth": 125000, "spreading_factor": 7}}, "frequency": "923200000"}
+    return {"payload": payload}
+
+
+def make_uplinks(count, devices=2000, actility_share=0.3, repr_share=0.01,
+                 start=datetime(2024, 10, 23, 4, 0, 0), seed=1):
+    """Returns count Kafka values (bytes), time-ordered, from `devices` devices."""
+    r = random.Random(seed)
+    applications = list(PROFILES)
+    fleet = []
+    for i in range(devices):
+        application_id = applications[i % len(applications)]
+        fleet.append((f"{0x70B3D57ED0000000 + i:016X}", application_id, r.random() < actility_share))
+
+    values = []
+    f_cnt = [0] * devices
+    step = timedelta(seconds=3600 / max(count, 1))
+    for i in range(count):
+        index = r.randrange(devices)
+        dev_eui, application_id, actility = fleet[index]
+        f_cnt[index] += 1
+        document = uplink(dev_eui, application_id, start + step * i, f_cnt[index],
+                          PROFILES[application_id](r), actility)
+        if r.random() < repr_share:
+            values.append(repr(document).encode("utf-8"))
+        else:
+            values.append(json.dumps(document).encode("utf-8"))
+    return values
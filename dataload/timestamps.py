@@ -0,0 +1,71 @@
+import re
+from datetime import datetime
+
+# received_at comes as "2024-10-23T04:35:29.123456789Z" from TTS and as
+# "2024-10-23T04:35:29+0000" from Actility, sometimes with a shorter fraction.
+# Every result is a naive UTC datetime, like the strptime calls this replaces.
+
+_ISO = re.compile(r"(\d{4}-\d\d-\d\d[T ]\d\d:\d\d:\d\d)(?:\.(\d+))?(Z|[+-]\d\d:?\d\d)?$")
+
+
+class TimestampParser:
+    """Parses received_at with datetime.fromisoformat instead of strptime.
+
+    yearmonth and the start of the hour are cached per hour prefix
+    ("2024-10-23T04"), so they are computed once per hour rather than once
+    per message. With fraction=False timestamps are truncated to seconds.
+    """
+
+    CACHE_SIZE = 256
+
+    def __init__(self, fraction=True):
+        self.fraction = fraction
+        self.hours = {}
+
+    def parse(self, received_at):
+        """Returns (ts, yearmonth, hour_start) for a received_at string."""
+        # Strip the UTC suffixes first so the common case gets a naive datetime
+        # straight from fromisoformat.
+        if received_at[-1] == "Z":
+            text = received_at[:-1]
+        elif received_at.endswith("+0000"):
+            text = received_at[:-5]
+        else:
+            text = received_at
+        try:
+            ts = datetime.fromisoformat(text)
+        except ValueError:
+            ts = self._parse_fallback(received_at)
+
+        key = received_at[:13]
+        if ts.tzinfo is not None:
+            offset = ts.utcoffset()
+            ts = ts.replace(tzinfo=None)
+            if offset:
+                ts -= offset
+                key = ts.isoformat()[:13]
+        if not self.fraction and ts.microsecond:
+            ts = ts.replace(microsecond=0)
+
+        hour = self.hours.get(key)
+        if hour is None:
+            hour_start = ts.replace(minute=0, second=0, microsecond=0)
+            hour = (hour_start, (hour_start.year % 100) * 100 + hour_start.month)
+            if len(self.hours) >= self.CACHE_SIZE:
+                self.hours.clear()
+            self.hours[key] = hour
+        return ts, hour[1], hour[0]
+
+    def _parse_fallback(self, received_at):
+        # Before Python 3.11 fromisoformat rejects "Z", "+0000" and fractions
+        # that are not 3 or 6 digits long, so rewrite those into a form it takes.
+        match = _ISO.match(received_at)
+        if match is None:
+            raise ValueError(f"bad timestamp {received_at!r}")
+        base, digits, offset = match.groups()
+        text = base
+        if digits:
+            text += "." + digits[:6].ljust(6, "0")
+        if offset and offset != "Z":
+            text += offset[:3] + ":" + offset[-2:]
+        return datetime.fromisoformat(text)
@@ -0,0 +1,135 @@
+import json
+
+try:
+    import orjson
+    fast_loads = orjson.loads
+except ImportError:
+    fast_loads = json.loads
+
+from flatten import NUMBERS, PayloadFlattener
+from sources import TtsSource
+
+
+class UplinkDecoder:
+    """Turns raw Kafka values into device_data rows, a whole batch per call.
+
+    One decoder is created per loader and reused, so the measurement map
+    and the timestamp parsers are looked up once instead of once per message.
+    measurements is a measurements.MeasurementMap; decoded payloads are
+    flattened through a flatten.PayloadFlattener over it, so nested objects
+    are read as dotted keys and each payload shape is mapped only once.
+    sources maps each topic to its source decoder (see sources.py), which
+    picks dev_eui, application_id, received_at and the decoded payload out
+    of a document and parses received_at into (ts, yearmonth, hour_start).
+    Topics without an entry use a sources.TtsSource around parse_ts
+    (a timestamps.TimestampParser.parse when not given).
+    loads is the JSON parser (orjson when installed); values it rejects go
+    to the optional quarantine instead of being retried inline, with their
+    Kafka (partition, offset) from positions when the caller passes them.
+    With a registry.DeviceRegistry, uplinks of unregistered devices are
+    counted and, with drop_unknown, dropped, or handed to divert (a
+    callable taking the parsed document) instead of being written.
+    With a dedup.RecentUplinks, an uplink whose (dev_eui, f_cnt,
+    received_at) was seen recently is dropped as a duplicate.
+    archive, when given, is called with every document of an archived
+    source that is not a duplicate and has a dev_eui and application_id
+    (see archive.UplinkArchive.add).
+    """
+
+    def __init__(self, measurements, parse_ts=None, loads=None, quarantine=None,
+                 registry=None, drop_unknown=False, divert=None, dedup=None, archive=None, sources=None):
+        self.measurements = measurements
+        self.flattener = PayloadFlattener(measurements)
+        self.source = TtsSource(parse_ts)
+        self.sources = sources or {}
+        self.loads = loads or fast_loads
+        self.quarantine = quarantine
+        self.registry = registry
+        self.drop_unknown = drop_unknown
+        self.divert = divert
+        self.dedup = dedup
+        self.archive = archive
+
+        self.messages = 0
+        self.rows = 0
+        self.skipped = 0
+        self.parse_failures = 0
+        self.unmapped = 0
+        self.unknown = 0
+        self.duplicates = 0
+
+    def decode_batch(self, values, topic=None, positions=None):
+        """Rows for the values of one topic, plus any recovered quarantined documents."""
+        loads = self.loads
+        quarantine = self.quarantine
+        documents = []
+        for i, value in enumerate(values):
+            try:
+                documents.append(loads(value))
+            except ValueError:
+                self.parse_failures += 1
+                if quarantine is not None:
+                    quarantine.put(value, topic, positions[i] if positions is not None else None)
+
+        rows = []
+        if quarantine is not None:
+            for recovered_topic, data in quarantine.drain():
+                self._decode(self.sources.get(recovered_topic, self.source), [data], rows)
+        self._decode(self.sources.get(topic, self.source), documents, rows)
+        self.messages += len(values)
+        self.rows += len(rows)
+        return rows
+
+    def _decode(self, source, documents, rows):
+        append = rows.append
+        self.flattener.refresh()
+        plan_for = self.flattener.plan
+        fields = source.uplink
+        parse_ts = source.parse_ts
+        registry = self.registry if source.registered else None
+        dedup = self.dedup
+        archive = self.archive if source.archived else None
+        unmapped = 0
+        for data in documents:
+            try:
+                uplink = fields(data)
+                if uplink is None:
+                    self.skipped += 1
+                    continue
+                dev_eui, application_id, f_cnt, received_at, decoded = uplink
+                plan = plan_for(application_id, decoded)
+                if dedup is not None and dedup.seen((dev_eui, f_cnt, received_at)):
+                    self.duplicates += 1
+                    continue
+                ts, yearmonth, hour_start = parse_ts(received_at)
+            except (KeyError, IndexError, TypeError, ValueError, AttributeError):
+                self.skipped += 1
+                continue
+            if not dev_eui or not application_id:
+                self.skipped += 1
+                continue
+            if archive is not None:
+                archive(data)
+            if registry is not None and registry.is_unknown(dev_eui):
+                self.unknown += 1
+                if self.divert is not None:
+                    self.divert(data)
+                    continue
+                if self.drop_unknown:
+                    continue
+
+            if plan.get is not None:
+                for measurement, value in zip(plan.measurements, plan.get(decoded)):
+                    if isinstance(value, NUMBERS):
+                        append((dev_eui, measurement, yearmonth, ts, application_id, value))
+            for path, measurement in plan.nested:
+                value = decoded
+                try:
+                    for key in path:
+                        value = value[key]
+                except (KeyError, TypeError, IndexError):
+                    continue
+                if isinstance(value, NUMBERS):
+                    append((dev_eui, measurement, yearmonth, ts, application_id, value))
+            unmapped += plan.unmapped
+        self.unmapped += unmapped
@@ -0,0 +1,305 @@
+import time
+from datetime import datetime
+from itertools import chain
+
+from cassandra.query import BatchStatement, BatchType, ConsistencyLevel
+from cassandra.concurrent import execute_concurrent
+
+from breaker import CLOSED
+from rowbuffer import RowBuffer, StringTable
+
+
+# Rows are (dev_eui, measurement, yearmonth, ts, source_application_id, value),
+# the bind order of data_prepared. latest_prepared takes the same row minus yearmonth.
+# They are buffered in a rowbuffer.RowBuffer and only turned back into bind
+# tuples, with ts as epoch milliseconds, while a flush sends them.
+
+class CassandraWriter:
+    """Buffers measurement rows and writes them to device_data/latest_data.
+
+    A flush is due when max_rows rows are pending or max_interval seconds have
+    passed since the last one; a flush_scheduler.FlushScheduler can lower
+    both through flush_rows and interval. mode "concurrent" sends every row
+    as its own execute_async with at most `concurrency` requests in flight,
+    mode "batch" is the old logged BatchStatement path, kept so both can be
+    compared.
+    mode "partition" groups rows by the device_data partition key (dev_eui,
+    measurement, yearmonth) and sends one UNLOGGED batch of up to batch_rows
+    rows per group, concurrently like single rows. A single-partition batch
+    carries the routing key of its rows, so the driver's token-aware policy
+    sends it straight to a replica; it only pays off when devices report
+    several values per measurement between flushes.
+    latest_data gets one write per (dev_eui, measurement) per flush, or none
+    at all with write_latest=False (backfills, see replay.py).
+
+    With a breaker.CircuitBreaker and a backlog.Backlog set, a flush while
+    the breaker is open writes the device_data rows to a backlog segment
+    instead and keeps only the latest_data rows, which are saved in the
+    backlog until a flush writes them. Every successful flush
+    then also writes up to drain_rate rows per second since the last one,
+    at most drain_max_rows, from the oldest segments to device_data.
+    """
+
+    def __init__(self, session, data_prepared, latest_prepared,
+                 mode="concurrent", max_rows=5000, max_interval=15, concurrency=64, batch_rows=100,
+                 write_latest=True):
+        self.session = session
+        self.data_prepared = data_prepared
+        self.latest_prepared = latest_prepared
+        self.data_prepared.consistency_level = ConsistencyLevel.ONE
+        self.latest_prepared.consistency_level = ConsistencyLevel.ONE
+        self.mode = mode
+        self.max_rows = max_rows
+        self.max_interval = max_interval
+        self.concurrency = concurrency
+        self.batch_rows = batch_rows
+        self.write_latest = write_latest
+
+        # what due() goes by; a FlushScheduler moves them within max_rows/max_interval
+        self.flush_rows = max_rows
+        self.interval = max_interval
+
+        # the buffer also tracks the newest row per (dev_eui, measurement) since
+        # the last flush; latest_data only keeps the last value, so only these
+        # rows are written there
+        self.strings = StringTable()
+        self.buffer = RowBuffer(self.strings)
+        self.last_flush = time.monotonic()
+
+        self.rows_written = 0
+        self.latest_written = 0
+        self.latest_coalesced = 0
+        self.flush_count = 0
+        self.failed_flushes = 0
+        self.last_flush_failed = False
+        self.last_flush_wrote = False  # the last flush wrote its rows to Cassandra, not failed or spilled
+        self.last_success = None
+        self.last_flush_seconds = 0.0
+        self.last_rate = 0.0
+        self.partition_batches = 0
+
+        self.breaker = None
+        self.backlog = None
+        self.drain_rate = 2000
+        self.drain_max_rows = 20000
+        self.last_drain = time.monotonic()
+        self.spilled_flushes = 0
+        self.spilled_rows = 0
+        self.drained_rows = 0
+
+    def add(self, row):
+        self.buffer.add_many((row,), self.write_latest)
+
+    def add_many(self, rows):
+        self.buffer.add_many(rows, self.write_latest)
+
+    def pending(self):
+        return len(self.buffer)
+
+    def due(self):
+        elapsed = time.monotonic() - self.last_flush
+        if self.last_flush_failed:
+            # after a failed flush, full buffer or not, wait out the whole interval
+            return elapsed >= self.max_interval
+        return len(self.buffer) >= self.flush_rows or elapsed >= self.interval
+
+    def flush(self):
+        """Writes all pending rows. Returns True when every row was written,
+        or spilled to the backlog; rows that failed stay buffered for the
+        next flush."""
+        self.last_flush = time.monotonic()
+        self.last_flush_wrote = False
+        buffer = self.buffer
+        if self.breaker is not None and not self.breaker.allow():
+            return self._spill(buffer)
+        if not len(buffer) and not buffer.latest:
+            self._drain()
+            return True
+
+        count = len(buffer)
+        latest = list(buffer.latest.values())
+        self.buffer = RowBuffer(self.strings)
+        start = time.monotonic()
+        failed, failed_latest = self._write(buffer, latest)
+
+        elapsed = time.monotonic() - start
+        written = count - len(failed)
+        self.rows_written += written
+        self.latest_written += len(latest) - len(failed_latest)
+        if self.write_latest:
+            self.latest_coalesced += count - len(latest)
+        self.flush_count += 1
+        self.last_flush_seconds = elapsed
+        if elapsed > 0:
+            self.last_rate = written / elapsed
+
+        self.last_flush_failed = bool(failed or failed_latest)
+        if failed or failed_latest:
+            self.failed_flushes += 1
+            if self.breaker is not None:
+                self.breaker.failure()
+            # flush runs on the thread that adds rows, so nothing came in meanwhile
+            self.buffer = retry = RowBuffer(self.strings)
+            retry.start = len(failed_latest)
+            retry.latest = {buffer.key(i)[:2]: new for i, new in zip(failed_latest, retry.copy(buffer, failed_latest))}
+            retry.copy(buffer, failed)
+            print(f"{datetime.now()} {len(failed)} of {count} rows and {len(failed_latest)} of {len(latest)} "
+                  f"latest rows failed, kept for next flush")
+            return False
+
+        self.last_flush_wrote = True
+        if self.breaker is not None:
+            self.breaker.success()
+        if self.backlog is not None:
+            # the latest_data rows kept through an outage are written now
+            self.backlog.clear_latest()
+        if len(self.strings) > StringTable.MAX_STRINGS:
+            self.strings = StringTable()
+            self.buffer = RowBuffer(self.strings)
+        self.last_success = datetime.now()
+        print(f"{datetime.now()} {written} rows inserted, {len(latest)} latest in {elapsed:.2f}s "
+              f"({self.last_rate:.0f} rows/s, {self.mode})")
+        self._drain()
+        return True
+
+    def _write(self, buffer, latest):
+        """Sends a buffer in the current mode; returns the indices of the rows and latest rows that failed."""
+        try:
+            if self.mode == "batch":
+                return self._write_batch(buffer, latest)
+            if self.mode == "partition":
+                return self._write_partitions(buffer, latest)
+            return self._write_concurrent(buffer, latest)
+        except Exception as e:
+            print(e)
+            return range(buffer.start, len(buffer.values)), latest
+
+    def _spill(self, buffer):
+        """Moves the device_data rows of buffer to the backlog, keeping its latest_data rows buffered.
+
+        The kept latest_data rows are saved in the backlog as well, since
+        the offsets of the messages they came from are committed next.
+        """
+        count = len(buffer)
+        latest = list(buffer.latest.values())
+        carried = RowBuffer(self.strings)
+        carried.start = len(latest)
+        carried.latest = {buffer.key(i)[:2]: new for i, new in zip(latest, carried.copy(buffer, latest))}
+        try:
+            self.backlog.save_latest(carried, 0, carried.start)
+            self.backlog.spill(buffer, buffer.start, len(buffer.values))
+        except OSError as e:
+            # nothing is lost yet: the rows stay buffered and the offsets uncommitted
+            print(f"{datetime.now()} backlog spill of {count} rows failed: {e}")
+            return False
+        self.buffer = carried
+        self.last_flush_failed = False
+        if count:
+            self.spilled_flushes += 1
+            self.spilled_rows += count
+            print(f"{datetime.now()} circuit breaker open, {count} rows spilled to backlog "
+                  f"({self.backlog.rows()} waiting)")
+        return True
+
+    def degraded(self):
+        """True while the circuit breaker is not closed and rows go to the backlog."""
+        return self.breaker is not None and self.breaker.state != CLOSED
+
+    def restore_latest(self):
+        """Buffers the latest_data rows the backlog kept through a restart; call before anything is added."""
+        buffer = self.buffer
+        count = self.backlog.load_latest(buffer)
+        buffer.start = count
+        buffer.latest = {buffer.key(i)[:2]: i for i in range(count)}
+        return count
+
+    def _drain(self):
+        """Writes the oldest backlog rows, as many as the drain rate allows since the last drain."""
+        backlog = self.backlog
+        now = time.monotonic()
+        if backlog is None or not backlog.segments:
+            self.last_drain = now
+            return
+        budget = min(self.drain_rate * (now - self.last_drain), self.drain_max_rows)
+        if budget < 1:
+            return
+        self.last_drain = now
+        buffer = RowBuffer(self.strings)
+        try:
+            segments = backlog.load(buffer, budget)
+        except OSError as e:
+            print(f"{datetime.now()} backlog read failed: {e}")
+            return
+        if not segments:
+            return
+
+        start = time.monotonic()
+        failed, _ = self._write(buffer, [])
+        if failed:
+            # rows that did get written are written again next time, which Cassandra treats as an overwrite
+            self.breaker.failure()
+            print(f"{datetime.now()} {len(failed)} of {len(buffer)} backlog rows failed, segments kept")
+            return
+        # with nothing live to flush, a drain is the half-open probe
+        self.breaker.success()
+        backlog.remove(segments)
+        self.drained_rows += len(buffer)
+        print(f"{datetime.now()} {len(buffer)} backlog rows drained in {time.monotonic() - start:.2f}s "
+              f"({backlog.rows()} waiting)")
+
+    def _write_batch(self, buffer, latest):
+        data_batch = BatchStatement(consistency_level=ConsistencyLevel.ONE)
+        latest_batch = BatchStatement(consistency_level=ConsistencyLevel.ONE)
+        for row in buffer.rows():
+            data_batch.add(self.data_prepared, row)
+        for i in latest:
+            latest_batch.add(self.latest_prepared, buffer.latest_row(i))
+        if len(buffer):
+            self.session.execute(data_batch)
+        if latest:
+            self.session.execute(latest_batch)
+        return [], []
+
+    def _write_concurrent(self, buffer, latest):
+        data_prepared, latest_prepared = self.data_prepared, self.latest_prepared
+        statements = chain(((data_prepared, row) for row in buffer.rows()),
+                           ((latest_prepared, buffer.latest_row(i)) for i in latest))
+
+        results = execute_concurrent(self.session, statements,
+                                     concurrency=self.concurrency,
+                                     raise_on_first_error=False)
+        count = len(buffer)
+        failed = [buffer.start + i for i, (success, result) in enumerate(results[:count]) if not success]
+        failed_latest = [latest[i] for i, (success, result) in enumerate(results[count:]) if not success]
+        return failed, failed_latest
+
+    def _write_partitions(self, buffer, latest):
+        groups = {}
+        key = buffer.key
+        for i in range(buffer.start, len(buffer.values)):
+            groups.setdefault(key(i), []).append(i)
+
+        chunks = []
+        statements = []
+        row = buffer.row
+        for group in groups.values():
+            for i in range(0, len(group), self.batch_rows):
+                chunk = group[i:i + self.batch_rows]
+                if len(chunk) == 1:
+                    statements.append((self.data_prepared, row(chunk[0])))
+                else:
+                    batch = BatchStatement(batch_type=BatchType.UNLOGGED, consistency_level=ConsistencyLevel.ONE)
+                    for index in chunk:
+                        batch.add(self.data_prepared, row(index))
+                    statements.append((batch, None))
+                    self.partition_batches += 1
+                chunks.append(chunk)
+        statements.extend((self.latest_prepared, buffer.latest_row(i)) for i in latest)
+
+        results = execute_concurrent(self.session, statements,
+                                     concurrency=self.concurrency,
+                                     raise_on_first_error=False)
+        count = len(chunks)
+        failed = [index for i, (success, result) in enumerate(results[:count]) if not success for index in chunks[i]]
+        failed_latest = [latest[i] for i, (success, result) in enumerate(results[count:]) if not success]
+        return failed, failed_latest